@@ -21,15 +21,44 @@
 # This script imports the M3 file into Blender for editing
 
 
-import bpy
 import os
-
-from bpy.props import *
-from struct import unpack_from, calcsize
+import sys
+import mmap
+import json
+import hashlib
+import argparse
+import time
+import tarfile
+import zipfile
+import tempfile
+import zlib
+import threading
+import uuid
+import numpy as np
+
+from struct import Struct, pack, unpack_from, calcsize
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
 from os.path import basename
-from mathutils import Matrix
-from mathutils import Vector
-from bpy_extras.io_utils import ImportHelper
+from urllib.parse import quote
+from contextlib import contextmanager
+from bisect import bisect_right
+from fnmatch import fnmatchcase
+from collections import deque
+
+try:
+    import bpy
+
+    from bpy.props import *
+    from mathutils import Matrix
+    from mathutils import Vector
+    from bpy_extras.io_utils import ImportHelper
+    from bpy.app.handlers import persistent
+except ImportError:
+    # Running outside of Blender, only the parser and the converters are
+    # available
+    bpy    = None
+    Matrix = None
 
 bl_info = {
     'name'       : 'Import Blizzard M3 Models(.m3)',
@@ -46,12 +75,790 @@ bl_info = {
 }
 
 
+# Read-only file object over an in-memory buffer (bytes, mmap slice, ...)
+class BufferFile:
+
+    def __init__(self, buffer, name=""):
+        self.buffer   = memoryview(buffer)
+        self.name     = name
+        self.position = 0
+
+    def read(self, count=-1):
+        start = self.position
+        end   = len(self.buffer) if count < 0 else min(start + count, len(self.buffer))
+        self.position = end
+        return bytes(self.buffer[start:end])
+
+    def seek(self, position, whence=0):
+        if whence == 1:
+            position += self.position
+        elif whence == 2:
+            position += len(self.buffer)
+        self.position = position
+        return position
+
+    def tell(self):
+        return self.position
+
+    def read_at(self, offset, count):
+        return bytes(self.buffer[offset:offset + count])
+
+    def close(self):
+        self.buffer.release()
+
+# Serializes positional reads on file objects without file descriptor
+PREAD_LOCK = threading.Lock()
+
+def pread(file, offset, count):
+    '''Reads count bytes at offset without using or changing the position of
+    the file, so several threads can read from the same file'''
+    if hasattr(file, 'read_at'):
+        return file.read_at(offset, count)
+
+    try:
+        fd = file.fileno() if hasattr(os, 'pread') else None
+    except (AttributeError, OSError):
+        fd = None
+
+    if fd is not None:
+        chunks = []
+
+        # pread returns less than requested for very large reads
+        while count > 0:
+            chunk = os.pread(fd, count, offset)
+
+            if not chunk:
+                break
+
+            chunks.append(chunk)
+            offset += len(chunk)
+            count  -= len(chunk)
+
+        return b"".join(chunks)
+
+    with PREAD_LOCK:
+        position = file.tell()
+        file.seek(offset)
+        data = file.read(count)
+        file.seek(position)
+
+    return data
+
+
+def normalize_asset_path(path):
+    '''Returns the lookup key of an asset path. Paths inside the .mpq
+    archives are case insensitive and may use either separator.'''
+    path = path.replace("\\", "/").lower()
+
+    while path.startswith("./"):
+        path = path[2:]
+
+    return path.lstrip("/")
+
+
+# Asset located by the VirtualFileSystem
+class VirtualFile:
+
+    def __init__(self, mount, key, name):
+        self.mount = mount
+        self.key   = key
+        self.name  = name
+
+    @property
+    def path(self):
+        '''Path on disk or None if the asset lives inside a bundle'''
+        return self.mount.disk_path(self.key)
+
+    def open(self):
+        return self.mount.open(self.key)
+
+    def read(self):
+        return self.mount.read(self.key)
+
+
+# Loose files below a directory, the layout of an extracted .mpq archive
+class DirectoryMount:
+
+    def __init__(self, root):
+        self.root      = os.path.abspath(root)
+        self.basenames = None
+
+    def disk_path(self, key):
+        return key
+
+    def open(self, key):
+        return open(key, "rb")
+
+    def read(self, key):
+        with open(key, "rb") as f:
+            return f.read()
+
+    def find(self, path):
+        path = os.path.normpath(os.path.join(self.root, path))
+
+        if os.path.isfile(path):
+            return VirtualFile(self, path, path)
+
+        return None
+
+    def find_basename(self, filename):
+        # The directory is scanned only once, all further searches are
+        # answered from the index
+        if self.basenames is None:
+            self.basenames = {}
+
+            for prefix, directories, files in os.walk(self.root):
+                for f in files:
+                    self.basenames.setdefault(f.lower(), os.path.join(prefix, f))
+
+        path = self.basenames.get(filename.lower())
+
+        if path is None:
+            return None
+
+        return VirtualFile(self, path, path)
+
+    def close(self):
+        pass
+
+
+# Base class of zip and tar bundles, keeps the central directory index
+class ArchiveMount:
+
+    def __init__(self, path):
+        self.path      = path
+        self.members   = {}
+        self.basenames = {}
+        self.map       = None
+
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def add_member(self, name, member):
+        key = normalize_asset_path(name)
+        self.members[key] = member
+        self.basenames.setdefault(key.rsplit("/", 1)[-1], key)
+
+    def disk_path(self, key):
+        return None
+
+    def find(self, path):
+        key = normalize_asset_path(path)
+
+        if key in self.members:
+            return VirtualFile(self, key, self.path + "/" + key)
+
+        return None
+
+    def find_basename(self, filename):
+        key = self.basenames.get(filename.lower())
+
+        if key is None:
+            return None
+
+        return VirtualFile(self, key, self.path + "/" + key)
+
+    def mapped_member(self, offset, size):
+        return BufferFile(memoryview(self.map)[offset:offset + size], self.path)
+
+    def open(self, key):
+        raise NotImplementedError
+
+    def read(self, key):
+        file = self.open(key)
+
+        try:
+            return file.read()
+        finally:
+            file.close()
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # Member views are still referenced, the map is released
+                # together with them
+                pass
+
+
+class ZipMount(ArchiveMount):
+
+    def __init__(self, path):
+        ArchiveMount.__init__(self, path)
+        self.archive = zipfile.ZipFile(path)
+
+        for info in self.archive.infolist():
+            if not info.is_dir():
+                self.add_member(info.filename, info)
+
+    def data_offset(self, info):
+        # The local header may carry a different extra field than the
+        # central directory, so its lengths have to be read from the header
+        (name_length, extra_length) = unpack_from("<HH", self.map, info.header_offset + 26)
+        return info.header_offset + 30 + name_length + extra_length
+
+    def open(self, key):
+        info = self.members[key]
+
+        if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1 and self.map is not None:
+            return self.mapped_member(self.data_offset(info), info.file_size)
+
+        # Compressed members are streamed through the decompressor, the M3
+        # parser needs random access so the result is kept in memory
+        with self.archive.open(info) as stream:
+            return BufferFile(stream.read(), self.path)
+
+    def close(self):
+        self.archive.close()
+        ArchiveMount.close(self)
+
+
+class TarMount(ArchiveMount):
+
+    def __init__(self, path):
+        ArchiveMount.__init__(self, path)
+
+        try:
+            self.archive    = tarfile.open(path, "r:")
+            self.compressed = False
+        except tarfile.ReadError:
+            self.archive    = tarfile.open(path, "r:*")
+            self.compressed = True
+
+        for member in self.archive.getmembers():
+            if member.isfile():
+                self.add_member(member.name, member)
+
+    def open(self, key):
+        member = self.members[key]
+
+        if not self.compressed and self.map is not None:
+            return self.mapped_member(member.offset_data, member.size)
+
+        stream = self.archive.extractfile(member)
+
+        try:
+            return BufferFile(stream.read(), self.path)
+        finally:
+            stream.close()
+
+    def close(self):
+        self.archive.close()
+        ArchiveMount.close(self)
+
+
+def split_archive_path(filepath):
+    '''Splits a path like "Base.zip/Assets/Units/Marine.m3" into the bundle
+    and the member path. Returns None if no bundle is part of the path.'''
+    parts = filepath.replace("\\", "/").split("/")
+
+    for i in range(1, len(parts)):
+        archive = "/".join(parts[:i])
+
+        if os.path.isfile(archive):
+            return (archive, "/".join(parts[i:]))
+
+    return None
+
+
+# Virtual file system giving uniform access to loose files and zip/tar
+# bundles. Lookups first try the exact asset path in all mounts and then
+# fall back to the file name, like the search through the extracted .mpq
+# directory structure did before.
+class VirtualFileSystem:
+
+    def __init__(self, paths=()):
+        self.mounts  = []
+        # Mounts by absolute path, a bundle is indexed and mapped only once
+        # however often models are opened from it
+        self.mounted = {}
+        # Optional TextureProxyCache used for the textures
+        self.proxies = None
+
+        for path in paths:
+            self.mount(path)
+
+    def mount(self, path):
+        key = os.path.abspath(path)
+
+        if key in self.mounted:
+            return self.mounted[key]
+
+        if os.path.isdir(path):
+            mount = DirectoryMount(path)
+        elif zipfile.is_zipfile(path):
+            mount = ZipMount(path)
+        elif tarfile.is_tarfile(path):
+            mount = TarMount(path)
+        else:
+            raise Exception('import_m3: !ERROR! Unsupported asset bundle: %s' % path)
+
+        self.mounts.append(mount)
+        self.mounted[key] = mount
+        return mount
+
+    def find(self, path):
+        for mount in self.mounts:
+            result = mount.find(path)
+
+            if result is not None:
+                return result
+
+        filename = basename(path.replace("\\", "/"))
+
+        for mount in self.mounts:
+            result = mount.find_basename(filename)
+
+            if result is not None:
+                return result
+
+        return None
+
+    def open(self, path):
+        if os.path.isfile(path):
+            return open(path, "rb")
+
+        split = split_archive_path(path)
+
+        if split is not None:
+            (archive, member) = split
+            mount = self.mount(archive)
+            return mount.open(normalize_asset_path(member))
+
+        result = self.find(path)
+
+        if result is None:
+            raise FileNotFoundError(path)
+
+        return result.open()
+
+    def close(self):
+        for mount in self.mounts:
+            mount.close()
+
+        self.mounts  = []
+        self.mounted = {}
+
+
+# Directory for access logs of every M3File, tracing is off when not set
+TRACE_DIRECTORY = os.environ.get("BLENDM3_TRACE")
+
+# File object wrapper recording every seek and read as
+# (operation, offset, length, chunk tag, caller record type, source,
+# positional, thread). The length of a seek is the signed distance from the
+# previous position. Reads ahead of decoding are recorded as 'prefetch'
+# with the tags of the chunks they cover, the source of a read is
+# 'prefetch' when it was served from such a read and 'file' when it went to
+# the file. Positional reads (read_at) do not use the file position.
+class IOTracer:
+
+    def __init__(self, file, name=""):
+        self.file     = file
+        self.name     = name
+        self.events   = []
+        self.local    = threading.local()
+        self.position = file.tell()
+        self.size     = file.seek(0, 2)
+        file.seek(self.position)
+
+    @property
+    def context(self):
+        '''Stack of (chunk tag, record type) being decoded by this thread'''
+        if not hasattr(self.local, 'context'):
+            self.local.context = [('MD34', 'M3Header')]
+
+        return self.local.context
+
+    def record(self, operation, offset, length, source=None, tag=None, positional=False):
+        caller = self.context[-2][1] if len(self.context) > 1 and tag is None else None
+        tag    = tag or self.context[-1][0]
+        self.events.append((operation, offset, length, tag, caller, source, positional, threading.get_ident()))
+
+    def source(self, offset, count):
+        covers = getattr(self.file, 'covers', None)
+        return 'prefetch' if covers is not None and covers(offset, count) else 'file'
+
+    def prefetch(self, ranges, tags):
+        '''Serves the reads inside the ranges from memory, tags returns the
+        chunk tags covered by a piece read. Returns the PrefetchedFile.'''
+        if not isinstance(self.file, PrefetchedFile):
+            self.file = PrefetchedFile(self.file)
+
+        for (start, end) in ranges:
+            for (piece_start, piece_end) in self.file.add(start, end):
+                self.record('prefetch', piece_start, piece_end - piece_start, 'file', "+".join(tags(piece_start, piece_end)), True)
+
+        return self.file
+
+    def read(self, count=-1):
+        offset = self.position
+        source = self.source(offset, count)
+        data   = self.file.read(count)
+        self.position = offset + len(data)
+        self.record('read', offset, len(data), source)
+        return data
+
+    def seek(self, position, whence=0):
+        previous      = self.position
+        self.position = self.file.seek(position, whence)
+        self.record('seek', self.position, self.position - previous)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read_at(self, offset, count):
+        source = self.source(offset, count)
+        data   = pread(self.file, offset, count)
+        self.record('read', offset, len(data), source, positional=True)
+        return data
+
+    def close(self):
+        self.file.close()
+
+    def statistics(self):
+        '''Summarizes the access pattern: number of calls, bytes read from
+        the file compared to the file size and the bytes read more than
+        once, seeks going backwards and the cost per chunk tag'''
+        reads  = [e for e in self.events if e[0] == 'read']
+        seeks  = [e for e in self.events if e[0] == 'seek']
+        disk   = [e for e in self.events if e[0] != 'seek' and e[5] == 'file']
+        total  = sum(e[2] for e in disk)
+        unique = 0
+        end    = 0
+
+        # Union of the intervals read from the file
+        for (offset, length) in sorted((e[1], e[2]) for e in disk):
+            if offset + length > end:
+                unique += offset + length - max(offset, end)
+                end     = offset + length
+
+        # Positional reads never seek, jumps are taken from the order of the
+        # offsets read from the file by each thread
+        ends      = {}
+        backward  = 0
+        scattered = 0
+
+        for e in disk:
+            end = ends.get(e[7])
+
+            if end is not None and e[1] != end:
+                scattered += 1
+                backward  += e[1] < end
+
+            ends[e[7]] = e[1] + e[2]
+
+        tags = {}
+
+        for (operation, offset, length, tag, caller, source, positional, thread) in self.events:
+            cost = tags.setdefault(tag, {'reads': 0, 'seeks': 0, 'bytes': 0, 'disk': 0})
+
+            if operation == 'seek':
+                cost['seeks'] += 1
+                continue
+
+            if operation == 'read':
+                cost['reads'] += 1
+                cost['bytes'] += length
+
+            if source == 'file':
+                cost['disk'] += length
+
+        return {'file'                : self.name,
+                'file_size'           : self.size,
+                'calls'               : len(self.events),
+                'reads'               : len(reads),
+                'positional'          : sum(1 for e in reads if e[6]),
+                'prefetched'          : sum(1 for e in reads if e[5] == 'prefetch'),
+                'prefetches'          : len(disk) - sum(1 for e in reads if e[5] == 'file'),
+                'seeks'               : len(seeks),
+                'backward_seeks'      : sum(1 for e in seeks if e[2] < 0),
+                'redundant_seeks'     : sum(1 for e in seeks if e[2] == 0),
+                'backward_reads'      : backward,
+                'nonsequential_reads' : scattered,
+                'threads'             : len(ends),
+                'bytes_requested'     : sum(e[2] for e in reads),
+                'bytes_read'          : total,
+                'bytes_unique'        : unique,
+                'bytes_reread'        : total - unique,
+                'amplification'       : total / self.size if self.size else 0.0,
+                'tags'                : tags}
+
+    def summary(self):
+        stats = self.statistics()
+        lines = ["%s: %d calls (%d reads, %d positional, %d seeks, %d backward, %d redundant)" %
+                 (stats['file'], stats['calls'], stats['reads'], stats['positional'], stats['seeks'], 
+                  stats['backward_seeks'], stats['redundant_seeks']),
+                 "  %d backward and %d non-sequential reads from the file in %d threads" % 
+                 (stats['backward_reads'], stats['nonsequential_reads'], stats['threads']),
+                 "  %d reads served by %d prefetches" % (stats['prefetched'], stats['prefetches']),
+                 "  %d of %d bytes read (%.2fx), %d bytes read more than once" %
+                 (stats['bytes_read'], stats['file_size'], stats['amplification'], stats['bytes_reread'])]
+
+        for tag, cost in sorted(stats['tags'].items(), key=lambda item: (-item[1]['disk'], -(item[1]['reads'] + item[1]['seeks']))):
+            lines.append("  %-4s %6d reads %6d seeks %10d bytes %10d from file" % 
+                         (tag, cost['reads'], cost['seeks'], cost['bytes'], cost['disk']))
+
+        return "\n".join(lines)
+
+    def write_log(self, path):
+        '''Writes the access pattern as JSON lines, the first line holds the
+        statistics'''
+        with open(path, "w") as f:
+            f.write(json.dumps(self.statistics()) + "\n")
+
+            for (operation, offset, length, tag, caller, source, positional, thread) in self.events:
+                f.write(json.dumps({'op': operation, 'offset': offset, 'length': length, 
+                                    'tag': tag, 'caller': caller, 'source': source, 
+                                    'positional': positional, 'thread': thread}) + "\n")
+
+
+# Chunks decoded by the importer, the vertex block (U8__) is left out as it
+# is read in one piece anyway. Only the chunks reachable from the model are
+# prefetched, see M3File.prefetch_chunks.
+PREFETCH_TAGS = frozenset((b'MODL', b'CHAR', b'LAYR', b'U16_', b'U32_', 
+                           b'MAT_', b'MATM', b'REGN', b'BAT_', b'DIV_', 
+                           b'STG_', b'BONE', b'IREF'))
+
+# Chunks prefetched for filtered imports, the face indices of the selected
+# regions are read on their own
+SELECTIVE_PREFETCH_TAGS = PREFETCH_TAGS - {b'U16_'}
+
+# Gaps up to this size between two chunks are read through instead of
+# starting a new read, chunks not needed are at most read as part of such a
+# gap
+PREFETCH_GAP = 4 * 1024
+
+def plan_prefetch(table, indices, end, gap=PREFETCH_GAP):
+    '''Returns the (start, end) byte ranges of the chunks with the given
+    reference table indices in ascending offset order, ranges closer than
+    gap are merged. A chunk reaches up to the next chunk, end bounds the
+    last one.'''
+    offsets    = table.Offset[table.Offset != 0].astype(np.int64)
+    boundaries = np.unique(np.append(offsets, end))
+    starts     = np.unique(table.Offset[np.asarray(indices, np.intp)].astype(np.int64))
+    starts     = starts[(starts != 0) & (starts < end)]
+    ends       = boundaries[np.searchsorted(boundaries, starts, 'right')]
+
+    ranges = []
+
+    for (start, stop) in zip(starts.tolist(), ends.tolist()):
+        if ranges and start - ranges[-1][1] <= gap:
+            ranges[-1][1] = stop
+        else:
+            ranges.append([start, stop])
+
+    return [tuple(r) for r in ranges]
+
+# File object serving reads from byte ranges read ahead, the ranges are
+# kept in ascending offset order. Reads outside of the ranges go to the file.
+class PrefetchedFile:
+
+    def __init__(self, file, ranges=()):
+        self.file     = file
+        self.position = file.tell()
+        self.starts   = []
+        self.buffers  = []
+
+        for (start, end) in ranges:
+            self.add(start, end)
+
+    def add(self, start, end):
+        '''Reads the range ahead. Buffers overlapping or touching it are
+        merged with it, so a chunk always lies in a single buffer. Returns
+        the (start, end) pieces actually read from the file.'''
+        first = bisect_right(self.starts, start) - 1
+
+        if first < 0 or self.starts[first] + len(self.buffers[first]) < start:
+            first += 1
+
+        last = first
+
+        while last < len(self.starts) and self.starts[last] <= end:
+            last += 1
+
+        if first < last:
+            start = min(start, self.starts[first])
+            end   = max(end, self.starts[last - 1] + len(self.buffers[last - 1]))
+
+        parts    = []
+        pieces   = []
+        position = start
+
+        for i in range(first, last):
+            if self.starts[i] > position:
+                pieces.append((position, self.starts[i]))
+                parts.append(pread(self.file, position, self.starts[i] - position))
+
+            parts.append(self.buffers[i])
+            position = self.starts[i] + len(self.buffers[i])
+
+        if position < end:
+            pieces.append((position, end))
+            parts.append(pread(self.file, position, end - position))
+
+        self.starts[first:last]  = [start]
+        self.buffers[first:last] = [b"".join(parts)]
+
+        return pieces
+
+    def read(self, count=-1):
+        if count >= 0:
+            data = self.read_at(self.position, count)
+        else:
+            self.file.seek(self.position)
+            data = self.file.read(count)
+
+        self.position += len(data)
+        return data
+
+    def read_at(self, offset, count):
+        index = bisect_right(self.starts, offset) - 1
+
+        if index >= 0:
+            local  = offset - self.starts[index]
+            buffer = self.buffers[index]
+
+            if local + count <= len(buffer):
+                return buffer[local:local + count]
+
+        return pread(self.file, offset, count)
+
+    def covers(self, offset, count):
+        '''True if the bytes are served from the prefetched ranges'''
+        index = bisect_right(self.starts, offset) - 1
+
+        return index >= 0 and count >= 0 and offset + count <= self.starts[index] + len(self.buffers[index])
+
+    def seek(self, position, whence=0):
+        if whence == 1:
+            position += self.position
+        elif whence == 2:
+            position = self.file.seek(position, 2)
+        self.position = position
+        return position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.buffers = []
+        self.file.close()
+
 # M3 File representation encapsulating file handle
 class M3File:
 
-    def __init__(self, filepath):
-        self.file = open(filepath, "rb")
+    def __init__(self, filepath, filesystem=None, trace=None, prefetch=True):
+        if filesystem is not None:
+            self.file = filesystem.open(filepath)
+        else:
+            self.file = open(filepath, "rb")
+
         self.ReferenceTable = []
+        self.tracer         = None
+        self.prefetch       = prefetch
+
+        if trace if trace is not None else TRACE_DIRECTORY:
+            self.file = self.tracer = IOTracer(self.file, filepath)
+
+    def close(self):
+        self.file.close()
+
+        if self.tracer is not None and TRACE_DIRECTORY:
+            name = "%s.%d.trace.jsonl" % (basename(self.tracer.name), os.getpid())
+            os.makedirs(TRACE_DIRECTORY, exist_ok=True)
+            self.tracer.write_log(os.path.join(TRACE_DIRECTORY, name))
+            print(self.tracer.summary())
+
+    def prefetch_chunks(self, root, end, tags=PREFETCH_TAGS):
+        '''Reads the chunks with the given tags ahead of decoding, starting
+        from the chunk root. The references of the records are followed
+        like the decoder does, one level per round of a few large reads.
+        end bounds the last chunk.'''
+        table   = self.ReferenceTable
+        codes   = {M3ReferenceTable.tag_code(tag) for tag in tags}
+        visited = set()
+        level   = [root]
+
+        while level:
+            level = sorted({i for i in level if i not in visited and 0 <= i < len(table) and
+                                                table.Offset[i] != 0 and int(table.Id[i]) in codes})
+            visited.update(level)
+            ranges = plan_prefetch(table, level, end)
+
+            if not ranges:
+                break
+
+            prefetched = self.add_prefetch(ranges)
+            references = []
+
+            for index in level:
+                entry       = table[index]
+                record_type = PREFETCH_RECORD_TYPES.get(entry.Id)
+
+                if record_type is not None:
+                    (codec, stride) = self.record_stride(record_type, entry)
+                    data            = prefetched.read_at(entry.Offset, stride * entry.Count)
+                    references     += codec.reference_indices(data, entry.Count, stride)
+
+            level = references
+
+    def add_prefetch(self, ranges):
+        if self.tracer is None:
+            if not isinstance(self.file, PrefetchedFile):
+                self.file = PrefetchedFile(self.file)
+
+            for (start, end) in ranges:
+                self.file.add(start, end)
+
+            return self.file
+
+        # The tracer stays in front of the prefetched ranges, reads served
+        # from them are still attributed to the chunks being decoded
+        table = self.ReferenceTable
+
+        def covered(start, stop):
+            inside = (table.Offset >= start) & (table.Offset < stop)
+            return sorted({int(tag).to_bytes(4, "big").decode("ascii", "replace") for tag in table.Id[inside]})
+
+        return self.tracer.prefetch(ranges, covered)
+
+    def read_at(self, offset, count):
+        '''Reads count bytes at offset, the file position is not used'''
+        return pread(self.file, offset, count)
+
+    def submit(self, executor, function, *args):
+        '''Runs the decoding function in the executor, the chunk being
+        decoded is passed on to the tracer of the worker thread'''
+        if self.tracer is None:
+            return executor.submit(function, *args)
+
+        context = list(self.tracer.context)
+
+        def run():
+            self.tracer.local.context = list(context)
+            return function(*args)
+
+        return executor.submit(run)
+
+    @contextmanager
+    def traced(self, tag, record=None):
+        '''Attributes the reads and seeks inside to the chunk tag'''
+        if self.tracer is None:
+            yield
+            return
+
+        if isinstance(tag, bytes):
+            tag = tag.decode("ascii", "replace")
+
+        self.tracer.context.append((tag, record or tag))
+
+        try:
+            yield
+        finally:
+            self.tracer.context.pop()
         
     def seek(self, position, offset):
         self.file.seek(position, offset)
@@ -102,266 +909,317 @@ class M3File:
         id = self.read_string(4)
         return id[::-1]
         
-    def read_reference_entry(self):
-        ref = M3Reference(self)
-        
-        if (ref.Index != 0):
-            return self.ReferenceTable[ref.Index]
-        else:
-            return self.ReferenceTable[ref.Index]
-            # In non debug should return None
-            # return None
-
     def read_CHAR(self, entry):
-        offset = entry.Offset
-        count = entry.Count
-        
-        self.file.seek(offset)
-        string = self.read_string(count)
+        string = self.read_at(entry.Offset, entry.Count)
         string = string[0:-1].decode("ascii")
         return string
         
-    
-        
-    def read_reference_by_id(self):
-        entry = self.read_reference_entry()
-        
-        # Check for 'null' reference, return empty list
-        #print(entry.Id)
+    def resolve_reference(self, index):
+        '''Decodes the chunk of the reference table entry with the given
+        index, chunks are read at their offset and the file position is not
+        changed'''
+        entry = self.ReferenceTable[index]
 
         if (entry.Offset == 0):
             return None
-        
-        position = self.file.tell()
-        
-        if (entry.Id == b'CHAR'):
+
+        return self.read_entry(entry)
+
+    def read_entry(self, entry):
+        record_type = RECORD_TYPES.get(entry.Id)
+
+        with self.traced(entry.Id, record_type.__name__ if record_type else None):
+            return self.decode_entry(entry)
+
+    def decode_entry(self, entry):
+        if (entry.Id in RECORD_TYPES):
+            result = self.read_records(RECORD_TYPES[entry.Id], entry)
+        elif (entry.Id == b'CHAR'):
             result = self.read_CHAR(entry)
         elif (entry.Id == b'LAYR'):
             result = self.read_LAYR(entry)
-        elif (entry.Id == b'MAT_'):
-            result = self.read_MAT(entry)
-        elif (entry.Id == b'MATM'):
-            result = self.read_MATM(entry)
-        elif (entry.Id == b'REGN'):
-            result = self.read_REGN(entry)
-        elif (entry.Id == b'BAT_'):
-            result = self.read_BAT(entry)
         elif (entry.Id == b'MSEC'):
             result = self.read_MSEC(entry)
         elif (entry.Id == b'U16_'):
             result = self.readIndices(entry)
-        elif (entry.Id == b'DIV_'):
-            result = self.read_DIV(entry)
-        elif (entry.Id == b'STC_'):
-            result = self.read_STC(entry)
         elif (entry.Id == b'U32_'):
             result = self.read_U32(entry)
-        elif (entry.Id == b'BONE'):
-            result = self.read_BONE(entry)
-        elif (entry.Id == b'IREF'):
-            result = self.read_IREF(entry)
+        elif (entry.Id in ARRAY_TYPES):
+            result = self.read_array(entry, ARRAY_TYPES[entry.Id])
         else:
             #raise Exception('import_m3: !ERROR! Unsupported reference format. Format: %s Count: %s' % (str(entry.Id), str(entry.Count)))
             print('import_m3: !ERROR! Unsupported reference format. Format: %s Count: %s' % (str(entry.Id), str(entry.Count)))
             return entry
 
-        
-        self.file.seek(position)
-        
         return result
-        
-    def read_STC(self, reference):
-        stc = []
-        count  = reference.Count
-        offset = reference.Offset
-        
-        self.file.seek(offset)
-        
-        for i in range(count):
-            stc.append(STC(self))
-            
-        return stc
-    
-    def read_MATM(self, reference):
-        matm = []
-        count = reference.Count
-        offset = reference.Offset
-        
-        self.file.seek(offset)
-        
-        for i in range(count):
-            matm.append(MATM(self))
-            
-        return matm
+
+    def iter_chunks(self, tag):
+        '''Yields (index, chunk) for every reference table entry of the
+        given type, e.g. iter_chunks(b'MAT_')'''
+        for index in self.ReferenceTable.indices(tag):
+            entry = self.ReferenceTable[index]
+
+            if entry.Offset != 0:
+                yield (int(index), self.read_entry(entry))
+
+    def record_stride(self, record_type, reference):
+        '''Returns the codec of the records of a reference and the distance
+        between two records. Versions without a layout of their own are
+        decoded with the closest layout, the stride is then derived from
+        the extent of the chunk.'''
+        codec = record_type.codec(reference.Type)
+
+        if codec.exact or reference.Count <= 1:
+            return (codec, codec.size)
+
+        # Chunks are padded to 16 bytes, records are 4 byte aligned
+        stride = (self.ReferenceTable.extent(reference.Offset) // reference.Count) & ~3
+
+        if stride < codec.size:
+            raise Exception('import_m3: !ERROR! Cannot determine the record size of %s version %d' % (str(reference.Id), reference.Type))
+
+        return (codec, stride)
+
+    def read_records(self, record_type, reference):
+        '''Decodes the whole array of records of a reference at once'''
+        (codec, stride) = self.record_stride(record_type, reference)
+        data            = self.read_at(reference.Offset, stride * reference.Count)
+
+        return codec.decode(self, data, reference.Count, stride=stride)
     
     def read_LAYR(self, reference):
-        layr = 0
-        count  = reference.Count
-        offset = reference.Offset
-        
-        self.file.seek(offset)
-        
-        if count != 1:
+        if reference.Count != 1:
             raise Exception("Unsupported LAYR count")
         
-        return LAYR(self)
+        return self.read_records(LAYR, reference)[0]
     
     def readIndices(self, reference):
-        faces = []
-        count = reference.Count
-        offset = reference.Offset
-        
-        self.file.seek(offset)
-        
-        for i in range(count):
-            faces.append(self.read_ushort())
-            
-        return faces
-    
-    def read_REGN(self, reference):
-        regions = []
-        count = reference.Count
-        offset = reference.Offset
-        
-        self.file.seek(offset)
-        
-        for i in range(count):
-            regions.append(REGN(self))
-            
-        return regions
-        
-    def read_BAT(self, reference):
-        bat    = []
-        count  = reference.Count
-        offset = reference.Offset
-        
-        self.file.seek(offset)
-        
-        for i in range(count):
-            bat.append(BAT(self))
-            
-        return bat
+        return np.frombuffer(self.read_at(reference.Offset, 2 * reference.Count), '<u2', reference.Count)
     
     def read_MSEC(self, reference):
         return 0
         
-    def read_MAT(self, reference):
-        mat = []
-        count = reference.Count
-        offset = reference.Offset
-        
-        self.file.seek(offset)
-        
-        for i in range(count):
-            mat.append(MAT(self))
-            
-        return mat
-        
-    def read_DIV(self, reference):
-        div = []
-        count = reference.Count
-        offset = reference.Offset
-        
-        self.file.seek(offset)
-        
-        for i in range(count):
-            div.append(DIV(self))
-            
-        return div
-        
     def read_U32(self, reference):
-        u32 = []
-        count  = reference.Count
-        offset = reference.Offset
-        
-        self.file.seek(offset)
-        
-        for i in range(count):
-            u32.append(self.read_uint)
-            
-        return u32
-        
-    def read_BONE(self, reference):
-        bones = []
-        
-        count  = reference.Count
-        offset = reference.Offset
-        
-        self.file.seek(offset)
-        
-        for i in range(count):
-            bones.append(BONE(self))
-            
-        return bones
-        
-    def read_IREF(self, reference):
-        matrices = []
-        
-        count  = reference.Count
-        offset = reference.Offset
-        
-        self.file.seek(offset)
-        
+        return np.frombuffer(self.read_at(reference.Offset, 4 * reference.Count), '<u4', reference.Count)
+
+    def read_array(self, reference, dtype):
+        return np.frombuffer(self.read_at(reference.Offset, dtype.itemsize * reference.Count), dtype, reference.Count)
+
+# Compiled form of a record layout. All fields of a record are unpacked
+# with a single struct, arrays of records with iter_unpack. References are
+# resolved through the reference table once the array has been unpacked.
+class RecordCodec:
+
+    def __init__(self, record_type, fields):
+        self.record_type = record_type
+        self.getters     = []
+        self.references  = []
+        
+        format   = "<"
+        position = 0
+        
+        for (name, kind) in fields:
+            base  = kind.lstrip("0123456789")
+            count = kind[:len(kind) - len(base)]
+
+            # A reference is stored as (count, index, flags), only the index
+            # of the reference table entry is kept
+            if base == 'ref' or base == 'entry':
+                size   = int(count or 1)
+                format += "3I" * size
+                getter = itemgetter(slice(position + 1, position + 3 * size, 3)) if count else itemgetter(position + 1)
+                position += 3 * size
+                self.references.append((name, base, count != ""))
+            else:
+                format += kind
+                size   = len(Struct("<" + kind).unpack(bytes(calcsize("<" + kind))))
+
+                if size == 0:
+                    continue
+                elif count and base != 's':
+                    getter = itemgetter(slice(position, position + size))
+                else:
+                    getter = itemgetter(position)
+
+                position += size
+
+            if name is not None:
+                self.getters.append((name, getter))
+
+        self.struct = Struct(format)
+        self.size   = self.struct.size
+        # False when the layout was declared for another chunk version
+        self.exact  = True
+
+    def unpack(self, values):
+        record = self.record_type.__new__(self.record_type)
+
+        for (name, getter) in self.getters:
+            setattr(record, name, getter(values))
+
+        return record
+
+    def decode(self, file, data, count, executor=None, stride=None):
+        '''Decodes count records, with an executor the referenced chunks
+        are decoded concurrently. A stride larger than the layout skips the
+        unknown trailing fields of every record.'''
+        if stride is None or stride == self.size:
+            records = [self.unpack(values) for values in self.struct.iter_unpack(data[:count * self.size])]
+        else:
+            records = [self.unpack(self.struct.unpack_from(data, i * stride)) for i in range(count)]
+
+        for record in records:
+            resolved = []
+
+            for (name, kind, is_array) in self.references:
+                value   = getattr(record, name)
+                indices = value if is_array else (value, )
+
+                if kind == 'entry':
+                    values = [file.ReferenceTable[index] for index in indices]
+                elif executor is not None:
+                    values = [file.submit(executor, file.resolve_reference, index) for index in indices]
+                else:
+                    values = [file.resolve_reference(index) for index in indices]
+
+                resolved.append((name, is_array, values))
+
+            for (name, is_array, values) in resolved:
+                values = [v.result() if isinstance(v, Future) else v for v in values]
+                setattr(record, name, tuple(values) if is_array else values[0])
+
+            record.finish(file)
+
+        return records
+
+    def reference_indices(self, data, count, stride=None):
+        '''Returns the reference table indices of all references of count
+        records without decoding them'''
+        getters = dict(self.getters)
+        stride  = stride or self.size
+        indices = []
+
         for i in range(count):
-            matrices.append(IREF(self))
-            
-        return matrices
-            
-class IREF:
+            values = self.struct.unpack_from(data, i * stride)
+
+            for (name, kind, is_array) in self.references:
+                if name in getters:
+                    value = getters[name](values)
+                    indices.extend(value if is_array else (value, ))
+
+        return indices
+
+    def read(self, file, executor=None):
+        '''Decodes a single record at the current file position'''
+        return self.decode(file, file.file.read(self.size), 1, executor)[0]
+
+    def read_at(self, file, offset, executor=None):
+        '''Decodes a single record at offset'''
+        return self.decode(file, file.read_at(offset, self.size), 1, executor)[0]
+
+# Base of all records declared by a field layout. LAYOUTS maps the chunk
+# version to a tuple of (name, format) fields. Formats are struct formats
+# or 'ref' for a reference resolved to its chunk and 'entry' for a
+# reference kept as reference table entry. Fields without name are padding.
+# Supporting a new chunk version only requires a new LAYOUTS entry.
+class M3Record:
+    __slots__ = ()
+
+    LAYOUTS = {}
+
+    @classmethod
+    def codec(record_type, version):
+        key = (record_type, version)
+
+        if key not in RECORD_CODECS:
+            versions = sorted(record_type.LAYOUTS)
+            known    = [v for v in versions if v <= version]
+            closest  = known[-1] if known else versions[0]
+
+            # Unknown versions are read with the closest known layout
+            codec       = RecordCodec(record_type, record_type.LAYOUTS[closest])
+            codec.exact = closest == version
+
+            if not codec.exact:
+                print('import_m3: !WARNING! Unknown %s version %d, read with the layout of version %d' % 
+                      (record_type.__name__, version, closest))
+
+            RECORD_CODECS[key] = codec
+
+        return RECORD_CODECS[key]
+
+    def finish(self, file):
+        pass
+
+RECORD_CODECS = {}
+
+class IREF(M3Record):
+    __slots__ = ('values', 'matrix')
+
+    LAYOUTS = {0: (('values', '16f'),)}
     
-    def __init__(self, file):
-        v1 = file.read_hvector()
-        v2 = file.read_hvector()
-        v3 = file.read_hvector()
-        v4 = file.read_hvector()
+    def finish(self, file):
+        v = self.values
         
-        self.matrix = Matrix((v1, v2, v3, v4)).transpose()
+        if Matrix is not None:
+            self.matrix = Matrix((v[0:4], v[4:8], v[8:12], v[12:16])).transpose()
+        else:
+            self.matrix = tuple(zip(v[0:4], v[4:8], v[8:12], v[12:16]))
         
         
         #print(self.matrix)
         
-class BONE:
-    
-    def __init__(self, file):
-        # TODO all signed!!!
-        self.d1     = file.read_uint()
-        self.name   = file.read_reference_by_id()
-        self.flags  = file.read_uint()
-        self.parent = file.read_short()
-        self.s1     = file.read_short()
-        
-        self.floats = []
-        for i in range(34):
-            self.floats.append(file.read_float())
-            
-        #print("Name: %s, Parent: %d, Flags: %s" % (self.name, self.parent, hex(self.flags)))
+class BONE(M3Record):
+    __slots__ = ('d1', 'name', 'flags', 'parent', 's1', 'floats')
 
-class STC:
-    
-    def __init__(self, file):
-        self.name      = file.read_reference_by_id()
-        self.d1        = file.read_uint()
-        self.indSTC    = file.read_uint()
-        self.animid    = file.read_reference_by_id()
-        self.animindex = file.read_reference_by_id()
-        self.d2        = file.read_uint()
-        
-        self.seq_data = []
-        for i in range(13):
-            self.seq_data.append(file.read_reference_by_id())
-            
+    # TODO all signed!!!
+    LAYOUTS = {1: (('d1',     'I'),
+                   ('name',   'ref'),
+                   ('flags',  'I'),
+                   ('parent', 'h'),
+                   ('s1',     'h'),
+                   ('floats', '34f'))}
 
-        #print("STC-------------------------------")
-        #print("Name:   %s" % self.name)
-        #print("IndStc: %d" % self.indSTC)
-        #print("----------------------------------")
+class STC(M3Record):
+    __slots__ = ('name', 'd1', 'indSTC', 'animid', 'animindex', 'd2', 'seq_data')
+    
+    LAYOUTS = {4: (('name',      'ref'),
+                   ('d1',        'I'),
+                   ('indSTC',    'I'),
+                   ('animid',    'ref'),
+                   ('animindex', 'ref'),
+                   ('d2',        'I'),
+                   ('seq_data',  '13ref'))}
+
+# Sequence transformation group, the STC indices of one sequence. The
+# groups are stored in the order of the sequences (SEQS) and share their
+# names.
+class STG(M3Record):
+    __slots__ = ('name', 'STCIndices')
+
+    LAYOUTS = {0: (('name',       'ref'),
+                   ('STCIndices', 'ref'))}
+
+# Animation track of a sequence, key times in milliseconds and the keys
+class SD(M3Record):
+    __slots__ = ('frames', 'flags', 'fend', 'keys')
+
+    LAYOUTS = {0: (('frames', 'ref'),
+                   ('flags',  'I'),
+                   ('fend',   'I'),
+                   ('keys',   'ref'))}
+
+class MATM(M3Record):
+    __slots__ = ('material_type', 'MaterialIndex')
 
-class MATM:
     #TYPES = {'MAT':1, 'DIS':2, 'CMP':3, 'TER':4, 'VOL':5}
     TYPES = {1:'MAT', 2:'DIS', 3:'CMP', 4:'TER', 5:'VOL'}
-    def __init__(self, file):
-        self.material_type  = MATM.TYPES[file.read_uint()]
-        self.MaterialIndex = file.read_uint()
+
+    LAYOUTS = {0: (('material_type', 'I'),
+                   ('MaterialIndex', 'I'))}
+
+    def finish(self, file):
+        self.material_type = MATM.TYPES[self.material_type]
         
         if (self.material_type != 'MAT'):
             print("Unsupported material type")
@@ -377,19 +1235,25 @@ def set_flags(bits, flag_defines):
             
     return flags
 
-class LAYR:
+class LAYR(M3Record):
+    __slots__ = ('Path',)
+
     #TYPES = [('COLOR', 0), ('SPECULARITY', 2), ('COLOR', 3), ('NORMAL', 9)]
     #TYPES = {'DIFFUSE':0, 'DECAL':1, 'SPECULAR':2, 'SELF_ILLUMINATION':3, 'EMISSIVE':4, 'ENVIO':5, 'ENVIO_MASK':6, 'ALPHA':7, 'UNKNOWN':8, 'NORMAL':9, 'HEIGHT':10}
     TYPES = {0:'DIFFUSIVE', 1:'DECAL', 2:'SPECULAR', 3:'EMISSIVE', 
              4:'EMISSIVE_COLOR', 5:'ENVIO', 6:'ENVIO_MASK', 7:'ALPHA', 8:'UNKNOWN1', 
              9:'NORMAL', 10:'HEIGHT', 11:'UNKNOWN2', 12:'UNKNOWN3'}
 
-
-    def __init__(self, file):
-        file.skip_bytes(4)
-        self.Path = file.read_reference_by_id()
+    # Only the texture path is used, LAYR is always read as single record
+    LAYOUTS = {22: ((None,   '4x'),
+                    ('Path', 'ref'))}
     
-class MAT:
+class MAT(M3Record):
+    __slots__ = ('Name', 'D1', 'flags', 'BlendMode', 'Priority', 'D2', 
+                 'specularity', 'F1', 'CutoutThreshold', 'specular_multiplier', 
+                 'EmissiveMultiplier', 'LayerReferences', 'Layers', 'D3', 
+                 'LayerBlend', 'EmissiveBlend', 'D4', 'specular_type')
+
     FLAGS = {'UNFOGGED_1'        :0x4, 
              'TWO_SIDED'         :0x8, 
              'UNSHADED'          :0x10, 
@@ -408,250 +1272,346 @@ class MAT:
                   'ALPHA_ADD'  :3,
                   'MOD'        :4,
                   'MOD2X'      :5}
+
+    LAYOUTS = {15: (('Name',                'ref'),
+                    ('D1',                  'I'),
+                    ('flags',               'I'),
+                    ('BlendMode',           'I'),
+                    ('Priority',            'I'),
+                    ('D2',                  'I'),
+                    ('specularity',         'f'),
+                    ('F1',                  'f'),
+                    ('CutoutThreshold',     'I'),
+                    ('specular_multiplier', 'f'),
+                    ('EmissiveMultiplier',  'f'),
+                    ('LayerReferences',     '13ref'),
+                    ('D3',                  'I'),
+                    ('LayerBlend',          'I'),
+                    ('EmissiveBlend',       'I'),
+                    ('D4',                  'I'),
+                    ('specular_type',       'I'),
+                    (None,                  '40x'))}
              
-    def __init__(self, file):
-        # Read chunk
-        self.Name                = file.read_reference_by_id()
-        self.D1                  = file.read_uint()
-        self.flags               = set_flags(file.read_uint(), MAT.FLAGS)
-        self.BlendMode           = file.read_uint()
-        self.Priority            = file.read_uint()
-        self.D2                  = file.read_uint()
-        self.specularity         = file.read_float()
-        self.F1                  = file.read_float()
-        self.CutoutThreshold     = file.read_uint()
-        self.specular_multiplier = file.read_float()
-        self.EmissiveMultiplier  = file.read_float()
-        
+    def finish(self, file):
+        self.flags  = set_flags(self.flags, MAT.FLAGS)
         self.Layers = {}
         
-        for i in range(13):
-            layer = file.read_reference_by_id()
-            
+        for i, layer in enumerate(self.LayerReferences):
             # Layer only exists if they have a path entry
             if (layer.Path != None and layer.Path != ""):
                 self.Layers[LAYR.TYPES[i]] = layer
-            
-        self.D3            = file.read_uint()
-        self.LayerBlend    = file.read_uint()
-        self.EmissiveBlend = file.read_uint()
-        self.D4            = file.read_uint()
-        self.specular_type = file.read_uint()
-        
-        file.skip_bytes(2*0x14)
         
         #print("spec: %f, %f, %d" % (self.specularity, self.specular_multiplier, self.specular_type))
                 
         
-class BAT:
+class BAT(M3Record):
+    __slots__ = ('REGN_Index', 'MAT_Index')
     
-    def __init__(self, file):
-        file.skip_bytes(4)
-        self.REGN_Index = file.read_ushort()
-        file.skip_bytes(4)
-        self.MAT_Index = file.read_ushort()
-        file.skip_bytes(2)
-        #print("BAT---------------------------------------------")
-        #print("REGN Index : " + str(self.REGN_Index))
-        #print("MAT Index  : " + str(self.MAT_Index))
-        #print("------------------------------------------------")
+    LAYOUTS = {1: ((None,         '4x'),
+                   ('REGN_Index', 'H'),
+                   (None,         '4x'),
+                   ('MAT_Index',  'H'),
+                   (None,         '2x'))}
+
+class REGN(M3Record):
+    __slots__ = ('D1', 'D2', 'OffsetVert', 'NumVert', 'OffsetFaces', 'NumFaces', 
+                 'BoneCount', 'IndBone', 'NumBone', 's1')
+
+    REGN3 = (('D1',          'I'),
+             ('D2',          'I'),
+             ('OffsetVert',  'I'),
+             ('NumVert',     'I'),
+             ('OffsetFaces', 'I'),
+             ('NumFaces',    'I'),
+             ('BoneCount',   'H'),
+             ('IndBone',     'H'),
+             ('NumBone',     'H'),
+             ('s1',          '3H'))
+
+    LAYOUTS = {3: REGN3,
+               4: REGN3 + ((None, '4x'),),
+               5: REGN3 + ((None, '12x'),)}
 
-class M3Reference:
+# TODO read bat and msec		
+class DIV(M3Record):
+    __slots__ = ('Indices', 'Regions', 'Bat', 'Msec')
 
-    def __init__(self, file):
-        self.Count = file.read_uint()
-        self.Index = file.read_uint()
-        self.Flags = file.read_uint()
-        
-class REGN:
-
-    def __init__(self, file):
-        self.D1           = file.read_uint()
-        self.D2           = file.read_uint()
-        self.OffsetVert   = file.read_uint()
-        self.NumVert      = file.read_uint()
-        self.OffsetFaces  = file.read_uint()
-        self.NumFaces     = file.read_uint()
-        self.BoneCount    = file.read_ushort()
-        self.IndBone      = file.read_ushort()
-        self.NumBone      = file.read_ushort()
-        self.s1           = file.readArrayUnsignedShort(3)
+    # The face indices are read per region, see read_indices
+    LAYOUTS = {2: (('Indices', 'entry'),
+                   ('Regions', 'ref'),
+                   ('Bat',     'ref'),
+                   ('Msec',    'ref'),
+                   (None,      '4x'))}
+
+    def read_indices(self, file, first, count):
+        '''Reads count face indices starting at index first'''
+        with file.traced(self.Indices.Id, 'DIV'):
+            data = file.read_at(self.Indices.Offset + 2 * first, 2 * count)
+
+        return np.frombuffer(data, '<u2', count)
 
-# TODO read bat and msec		
-class DIV:
-
-    def __init__(self, file):
-        print("Read Indices")
-        self.Indices = file.read_reference_by_id()
-        self.Regions = file.read_reference_by_id()
-        self.Bat     = file.read_reference_by_id()
-        self.Msec    = file.read_reference_by_id()
-
-        #print("M3Div-------------------------------------------")
-        #print("Vertex List Count  : " + str(referenceIndices.Count))
-        #print("Vertex List Offset : " + hex(referenceIndices.Offset))
-        #print("DIV List Count     : " + str(referenceRegions.Count))
-        #print("DIV List Offset    : " + hex(referenceRegions.Offset))
-        #print("BAT List Count     : " + str(referenceBat.Count))
-        #print("BAT List Offset    : " + hex(referenceBat.Offset))
-        #print("MSEC List Count    : " + str(referenceMsec.Count))
-        #print("MSEC List Offset   : " + hex(referenceMsec.Offset))
-        #print("------------------------------------------------")
 # VERTEX_TYPE stores the amount of UV per vertex
 VERTEX_TYPE = {'VERTEX32':1, 'VERTEX36':2, 'VERTEX40':3, 'VERTEX44':4}
-class M3Vertex:
-    
-    def __init__(self, file, type, flags):
-        self.type       = type
-        self.Position   = file.read_vector()
-        self.BoneWeight = file.read_bytes(4)
-        self.BoneIndex  = file.read_bytes(4)
-        self.Normal     = file.read_bytes(4)
-        self.UV         = []
-
-        # Vertex type specifies how many UV entries the Vertex format contains
-        for i in range(VERTEX_TYPE[type]):
-            (u, v) = file.readArraySignedShort(2)
-            u = u / 2048.0
-            v = v / 2048.0
-            
-            v = 1 - v
-            self.UV.append((u,v))
-        
-        # Further investigation of this flag needed
-        if ((flags & 0x200) != 0):
-            file.skip_bytes(4)
-            
-        self.Tangent    = file.read_bytes(4)
-
-class MODL23:
-    
-    def __init__(self):
-        self.Flags = 0
+def vertex_format(flags):
+    '''Returns the vertex type and the size of a vertex in bytes'''
+    if ((flags & 0x100000) != 0):   
+        type = 'VERTEX44'
+    elif ((flags & 0x80000) != 0):
+        type = 'VERTEX40'
+    elif ((flags & 0x40000) != 0):
+        type = 'VERTEX36'
+    elif ((flags & 0x20000) != 0):
+        type = 'VERTEX32'
+    else:
+        raise Exception('import_m3: !ERROR! Unsupported vertex format. Flags: %s' % hex(flags))
+
+    size = 28 + 4 * VERTEX_TYPE[type]
+
+    # Further investigation of this flag needed
+    if ((flags & 0x200) != 0):
+        size += 4
+
+    return (type, size)
+
+def vertex_dtype(flags):
+    '''Returns the NumPy dtype of the vertex format, used to decode whole
+    vertex blocks without per vertex objects'''
+    (type, size) = vertex_format(flags)
+
+    fields = [('Position',   '<f4', 3),
+              ('BoneWeight', 'u1',  4),
+              ('BoneIndex',  'u1',  4),
+              ('Normal',     'u1',  4),
+              ('UV',         '<i2', (VERTEX_TYPE[type], 2))]
+
+    if ((flags & 0x200) != 0):
+        fields.append(('Unknown', 'u1', 4))
+
+    fields.append(('Tangent', 'u1', 4))
+
+    return np.dtype(fields)
+
+# Vertices kept in their quantized file encoding (int16 UVs, packed normals
+# and tangents, byte bone weights) as one structured array, usually a view
+# of the bytes read from the file. Float arrays are dequantized when they
+# are requested and are not kept, so a model costs its file size in memory.
+class CompactVertices:
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        return CompactVertices(self.data[index])
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def positions(self):
+        return self.data['Position']
+
+    def normals(self):
+        return decode_normals(self.data['Normal'])
+
+    def tangents(self):
+        return decode_normals(self.data['Tangent'])
+
+    def uvs(self, flip_v=False):
+        '''Returns (vertex count, layer count, 2) UVs, flip_v points the v
+        axis up like in Blender'''
+        uvs = decode_uvs(self.data['UV'])
+
+        if flip_v:
+            uvs[..., 1] = 1.0 - uvs[..., 1]
+
+        return uvs
+
+    def bone_weights(self):
+        return self.data['BoneWeight'].astype(np.float32) * (1.0 / 255.0)
+
+    def bone_indices(self):
+        return self.data['BoneIndex']
+
+# Number of threads decoding the top level sections of a model
+SECTION_WORKERS = 4
+
+class MODL23(M3Record):
+
+    LAYOUTS = {23: (('name',             'ref'),
+                    ('version',          'I'),
+                    ('SEQS',             'ref'),
+                    # Animation data is decoded per sequence, see
+                    # SequenceIndex
+                    ('STC',              'entry'),
+                    ('STG',              'ref'),
+                    (None,               '28x'),
+                    ('Bones',            'ref'),
+                    ('d5',               'I'),
+                    ('Flags',            'I'),
+                    ('VertexReference',  'entry'),
+                    ('Div',              'ref'),
+                    ('BonesI',           'ref'),
+                    # Bounding Sphere
+                    ('vector0',          '3f'),
+                    ('vector1',          '3f'),
+                    ('radius',           'f'),
+                    ('boundingFlags',    'I'),
+                    (None,               '60x'),
+                    ('Attachments',      'ref'),
+                    ('AttachmentLookup', 'ref'),
+                    ('Lights',           'ref'),
+                    ('SHBX',             'ref'),
+                    ('Cameras',          'ref'),
+                    ('D',                'ref'),
+                    ('MaterialLookup',   'ref'),
+                    ('Materials',        'ref'),
+                    ('Displacement',     'ref'),
+                    ('CMP',              'ref'),
+                    ('TER',              'ref'),
+                    # VOL, CREP, PAR, PARC, RIB, PROJ, FOR, WRP, PHRB, IKJT,
+                    # PATU and TRGD are not read yet
+                    (None,               '216x'),
+                    ('IREF',             'ref'))}
+
+    def finish(self, file):
         self.Vertices = []
-        self.Faces = []
-        self.Materials = []
-        
-    def read(file):
-        m3model         = MODL23()
-        m3model.name    = file.read_reference_by_id()
-        m3model.version = file.read_uint()
-        m3model.SEQS    = file.read_reference_by_id()
-        m3model.STC     = file.read_reference_by_id()
-        m3model.STG     = file.read_reference_by_id()
-        
-        file.skip_bytes(0x1c)
-        m3model.Bones   = file.read_reference_by_id()
-        m3model.d5      = file.read_uint()
-        m3model.Flags   = file.read_uint()
-        vertexReference = file.read_reference_entry()
-        m3model.Div     = file.read_reference_by_id()[0] # expecting only one Div Entry
-        m3model.BonesI  = file.read_reference_by_id()
-        
-        # Bounding Sphere
-        vector0 = file.read_vector()
-        vector1 = file.read_vector()
-        radius  = file.read_float()
-        flags   = file.read_uint()
-        
-        file.skip_bytes(0x3C)
+        self.Faces    = []
+        self.Div      = self.Div[0] # expecting only one Div Entry
+        
+    def read_model(file, workers=SECTION_WORKERS):
+        '''Reads the model chunk and its vertex format without decoding the
+        vertices and building submeshes. The sections referenced by the
+        model (materials, bones, divisions, ...) are decoded by a pool of
+        workers.'''
+        codec = MODL23.codec(23)
+
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                m3model = codec.read(file, executor)
+        else:
+            m3model = codec.read(file)
+
+        (m3model.VertexType, m3model.VertexSize) = vertex_format(m3model.Flags)
+        m3model.VertexCount = m3model.VertexReference.Count // m3model.VertexSize
+
+        return m3model
         
-        m3model.Attachments      = file.read_reference_by_id()
-        m3model.AttachmentLookup = file.read_reference_by_id()
-        m3model.Lights           = file.read_reference_by_id()
-        m3model.SHBX             = file.read_reference_by_id()
-        m3model.Cameras          = file.read_reference_by_id()
-        m3model.D                = file.read_reference_by_id()
-        m3model.MaterialLookup   = file.read_reference_by_id()
-        m3model.Materials        = file.read_reference_by_id()
-        m3model.Displacement     = file.read_reference_by_id()
-        m3model.CMP              = file.read_reference_by_id()
-        m3model.TER              = file.read_reference_by_id()
-        #m3model.VOL              = file.read_reference_by_id()
-        #m3model.d21              = file.read_uint()
-        #m3model.d22              = file.read_uint()
-        #m3model.CREP             = file.read_reference_by_id()
-        #m3model.PAR              = file.read_reference_by_id()
-        #m3model.PARC             = file.read_reference_by_id()
-        #m3model.RIB              = file.read_reference_by_id()
-        #m3model.PROJ             = file.read_reference_by_id()
-        #m3model.FOR              = file.read_reference_by_id()
-        #m3model.WRP              = file.read_reference_by_id()
-        #m3model.d24              = file.read_uint()
-        #m3model.d25              = file.read_uint()
-        #m3model.PHRB             = file.read_reference_by_id()
-        #m3model.d27              = file.read_uint()
-        #m3model.d28              = file.read_uint()
-        #m3model.d29              = file.read_uint()
-        #m3model.d30              = file.read_uint()
-        #m3model.d32              = file.read_uint()
-        #m3model.d33              = file.read_uint()
-        #m3model.IKJT             = file.read_reference_by_id()
-        #m3model.d35              = file.read_uint()
-        #m3model.d36              = file.read_uint()
-        #m3model.PATU             = file.read_reference_by_id()
-        #m3model.TRGD             = file.read_reference_by_id()
-        file.skip_bytes(0xD8)
-        m3model.IREF             = file.read_reference_by_id()
+    def read(file, selection=None):
+        return MODL23.read_model(file).read_submeshes(file, selection)
+
+    def read_submeshes(self, file, selection=None):
+        if selection is not None:
+            # Only the vertices of the selected regions are read
+            return list(self.iter_submeshes(file, None, selection))
         
         # Reading Vertices
-        count = 0
-        type  = 0
-    
-        if ((m3model.Flags & 0x100000) != 0):   
-            count = vertexReference.Count // 44
-            type  = 'VERTEX44'
-                
-        elif ((m3model.Flags & 0x80000) != 0):
-            count = vertexReference.Count // 40
-            type  = 'VERTEX40'
+        print("Reading %s vertices, Flags: %s" % (self.VertexCount, hex(self.Flags)))
 
-        elif ((m3model.Flags & 0x40000) != 0):
-            count = vertexReference.Count // 36
-            type  = 'VERTEX36'
+        self.Vertices = self.read_vertices(file, 0, self.VertexCount)
+        
+        return list(self.iter_submeshes(file, self.Vertices))
 
-        elif ((m3model.Flags & 0x20000) != 0):
-            count = vertexReference.Count // 32
-            type  = 'VERTEX32'
-                
-        else:
-            raise Exception('import_m3: !ERROR! Unsupported vertex format. Flags: %s' % hex(m3model.Flags))
+    def read_vertices(self, file, first, count):
+        '''Reads count vertices starting at vertex first as CompactVertices'''
+        with file.traced(self.VertexReference.Id, 'MODL23'):
+            data = file.read_at(self.VertexReference.Offset + first * self.VertexSize, count * self.VertexSize)
 
-            
-        print("Reading %s vertices, Flags: %s" % (count, hex(m3model.Flags)))
+        return CompactVertices(np.frombuffer(data, vertex_dtype(self.Flags), count))
 
-        file.seek(vertexReference.Offset)
-        for i in range(count):
-             m3model.Vertices.append(M3Vertex(file, type, m3model.Flags))
-        
-        submeshes = []
-        Div = m3model.Div
+    def batches(self, selection=None):
+        '''Returns (batch index, batch, region, material) of the batches
+        accepted by the SubmeshFilter'''
+        result = []
 
-        for i, bat in enumerate(Div.Bat):
-            regn = Div.Regions[bat.REGN_Index]
-            
+        for i, bat in enumerate(self.Div.Bat):
+            regn     = self.Div.Regions[bat.REGN_Index]
+            material = self.Materials[self.MaterialLookup[bat.MAT_Index].MaterialIndex]
+
+            if selection is None or selection.accepts(i, bat, regn, material):
+                result.append((i, bat, regn, material))
+
+        return result
+
+    def iter_submeshes(self, file, vertices=None, selection=None):
+        '''Yields the submesh of every selected batch. Without the decoded
+        vertex block, the vertices of each region are read when the submesh
+        is built, so memory scales with the largest region only.'''
+        Div = self.Div
+
+        for (i, bat, regn, material) in self.batches(selection):
             offset = regn.OffsetVert
             count  = regn.NumVert
-            
-            vertices = m3model.Vertices[offset:offset + count]
-            faces = []
-            
-            for j in range(regn.OffsetFaces, regn.OffsetFaces + regn.NumFaces, 3):
-                faces.append((Div.Indices[j], Div.Indices[j+1], Div.Indices[j+2]))
+
+            if vertices is None:
+                region = self.read_vertices(file, offset, count)
+            else:
+                region = vertices[offset:offset + count]
+
+            indices = Div.read_indices(file, regn.OffsetFaces, regn.NumFaces)
+            faces   = indices.reshape(-1, 3)
                 
-            submesh = Submesh(vertices, faces, m3model.Materials[m3model.MaterialLookup[bat.MAT_Index].MaterialIndex], m3model.IREF, m3model.Bones)
-            submeshes.append(submesh)
-            
-        
-        return submeshes
+            submesh = Submesh(region, faces, material, self.IREF, self.Bones)
+            submesh.Bat    = i
+            submesh.Region = bat.REGN_Index
+
+            # Content hashes used to find the regions changed on reimport
+            submesh.VertexHash   = content_hash(region.data)
+            submesh.TopologyHash = content_hash(indices)
+            submesh.MaterialHash = material_hash(submesh.Material)
+
+            yield submesh
+                    
+# Record types decoded through their field layout, by reference tag
+RECORD_TYPES = {b'MAT_': MAT,
+                b'MATM': MATM,
+                b'REGN': REGN,
+                b'BAT_': BAT,
+                b'DIV_': DIV,
+                b'STC_': STC,
+                b'STG_': STG,
+                b'BONE': BONE,
+                b'IREF': IREF}
+
+# Tracks of the 13 sequence data references of a STC
+for tag in (b'SDEV', b'SD2V', b'SD3V', b'SD4Q', b'SDCC', b'SDR3', 
+            b'SDU8', b'SDS6', b'SDU6', b'SDU3', b'SDFG', b'SDMB'):
+    RECORD_TYPES[tag] = SD
+
+# Chunks decoded as plain arrays
+ARRAY_TYPES = {b'I16_': np.dtype('<i2'),
+               b'I32_': np.dtype('<i4'),
+               b'U8__': np.dtype('u1'),
+               b'FLAG': np.dtype('<u4'),
+               b'REAL': np.dtype('<f4'),
+               b'VEC2': np.dtype(('<f4', 2)),
+               b'VEC3': np.dtype(('<f4', 3)),
+               b'VEC4': np.dtype(('<f4', 4)),
+               b'QUAT': np.dtype(('<f4', 4)),
+               b'COL ': np.dtype(('u1', 4)),
+               b'BNDS': np.dtype(('<f4', 7))}
+
+# Records whose references are followed when prefetching, the other chunks
+# are read as a whole
+PREFETCH_RECORD_TYPES = {**RECORD_TYPES, b'LAYR': LAYR, b'MODL': MODL23}
                     
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+def material_hash(material):
+    layers = sorted((key, layer.Path) for key, layer in material.Layers.items())
+    return content_hash(repr((material.Name, material.BlendMode, material.specular_type, layers)).encode("utf-8"))
+
 class M3ReferenceEntry:
+    __slots__ = ('Id', 'Offset', 'Count', 'Type')
     
-    def __init__(self, file):
-        self.Id     = file.read_id()
-        self.Offset = file.read_uint()
-        self.Count  = file.read_uint()
-        self.Type   = file.read_uint()
+    def __init__(self, Id, Offset, Count, Type):
+        self.Id     = Id
+        self.Offset = Offset
+        self.Count  = Count
+        self.Type   = Type
         
     # def print(self):
         # DEBUG
@@ -661,36 +1621,540 @@ class M3ReferenceEntry:
         #print("Count:  " + hex(self.Count))
         #print("Type:   " + hex(self.Type))
         #print("------------------------------------------------")
+
+# Reference table decoded in one read into columns. The tag is kept as
+# integer whose big endian bytes are the id returned by read_id.
+class M3ReferenceTable:
+    DTYPE = np.dtype([('Id', '<u4'), ('Offset', '<u4'), ('Count', '<u4'), ('Type', '<u4')])
+
+    def __init__(self, data=b"", count=0):
+        table = np.frombuffer(data, M3ReferenceTable.DTYPE, count)
+
+        self.Id     = table['Id'].copy()
+        self.Offset = table['Offset'].copy()
+        self.Count  = table['Count'].copy()
+        self.Type   = table['Type'].copy()
+        self.index  = None
+        # Offset of the table, the chunks end before it
+        self.end        = None
+        self.boundaries = None
+
+    def read(file, offset, count):
+        table     = M3ReferenceTable(file.read_at(offset, count * M3ReferenceTable.DTYPE.itemsize), count)
+        table.end = offset
+        return table
+
+    def extent(self, offset):
+        '''Returns the bytes from offset up to the next chunk, 0 if unknown'''
+        if self.boundaries is None:
+            offsets = self.Offset[self.Offset != 0].astype(np.int64)
+
+            if self.end is not None:
+                offsets = np.append(offsets, self.end)
+
+            self.boundaries = np.unique(offsets)
+
+        index = np.searchsorted(self.boundaries, offset, 'right')
+
+        return int(self.boundaries[index]) - offset if index < len(self.boundaries) else 0
+
+    def tag_code(tag):
+        if isinstance(tag, str):
+            tag = tag.encode("ascii")
+
+        return int.from_bytes(tag, "big")
+
+    def __len__(self):
+        return len(self.Id)
+
+    def __getitem__(self, index):
+        return M3ReferenceEntry(int(self.Id[index]).to_bytes(4, "big"),
+                                int(self.Offset[index]),
+                                int(self.Count[index]),
+                                int(self.Type[index]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def build_index(self):
+        # Sorting the tags once groups the entries of each tag into one
+        # contiguous run of the order array
+        order = np.argsort(self.Id, kind='stable')
+        (tags, starts) = np.unique(self.Id[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+
+        self.index = {}
+
+        for tag, start, end in zip(tags, starts, ends):
+            self.index[int(tag)] = order[start:end]
+
+    def indices(self, tag):
+        '''Returns the indices of all entries with the given tag'''
+        if self.index is None:
+            self.build_index()
+
+        return self.index.get(M3ReferenceTable.tag_code(tag), np.empty(0, np.intp))
+
+    def entries(self, tag):
+        for index in self.indices(tag):
+            yield self[index]
+
+    def tags(self):
+        '''Returns a dictionary of all tags and their number of entries'''
+        if self.index is None:
+            self.build_index()
+
+        return {tag.to_bytes(4, "big"): len(indices) for tag, indices in self.index.items()}
                 
 class M3Header:
 
-    def __init__(self, file):
-        self.id                   = file.read_id()
-        
-        if self.id != b'MD34':
-            raise Exception('import_m3: !ERROR! Unsupported file format: %s' % self.id)
+    def __init__(self, file, reader=None):
+        self.id                   = file.read_id()
+        
+        if self.id != b'MD34':
+            raise Exception('import_m3: !ERROR! Unsupported file format: %s' % self.id)
+            
+        reference_table_offset = file.read_uint()
+        reference_table_count  = file.read_uint()
+        model_count            = file.read_uint()
+        model_index            = file.read_uint()
+        
+        # Creating reference table
+        file.ReferenceTable = M3ReferenceTable.read(file, reference_table_offset, reference_table_count)
+
+        # Creating models
+        modelReference = file.ReferenceTable[model_index]
+        
+        if (modelReference.Type != 23):
+            raise Exception('import_m3: !ERROR! Unsupported model format: %s' % hex(modelReference.Type))
+
+        if file.prefetch:
+            file.prefetch_chunks(model_index, reference_table_offset, PREFETCH_TAGS if file.prefetch is True else file.prefetch)
+
+        file.seek(modelReference.Offset)
+        
+        assert(modelReference.Count == 1)
+
+        # By default the submeshes are built, other readers can decode only
+        # the parts of the model they need
+        with file.traced(modelReference.Id, 'MODL23'):
+            self.m3Model = (reader or MODL23.read)(file)
+
+# Index from the sequence names to their STC records. Only the sequence
+# groups are decoded up front, the animation tracks of a sequence are read
+# when the sequence is requested.
+class SequenceIndex:
+
+    def __init__(self, model, file):
+        self.file      = file
+        self.entry     = model.STC
+        self.sequences = {}
+
+        for stg in (model.STG or []):
+            indices = stg.STCIndices if stg.STCIndices is not None else []
+            self.sequences[stg.name] = [int(i) for i in indices]
+
+    def names(self):
+        return list(self.sequences)
+
+    def missing(self, names):
+        '''Returns the given names without a sequence in the file'''
+        return [name for name in names if name not in self.sequences]
+
+    def read(self, names):
+        '''Decodes the STC records and tracks of the given sequences, returns
+        a dictionary from sequence name to STC records. Unknown names are
+        skipped.'''
+        file            = self.file
+        (codec, stride) = file.record_stride(STC, self.entry)
+        result          = {}
+
+        for name in names:
+            if name not in self.sequences:
+                continue
+
+            records = []
+
+            with file.traced(self.entry.Id, 'SequenceIndex'):
+                for index in self.sequences[name]:
+                    records.append(codec.read_at(file, self.entry.Offset + index * stride))
+
+            result[name] = records
+
+        return result
+
+    def ranges(self, names):
+        '''Returns the (first, last) key time in milliseconds of the given
+        sequences'''
+        return {name: list(sequence_range(records)) for name, records in self.read(names).items()}
+
+def sequence_range(records):
+    '''Returns (first, last) key time in milliseconds of the STC records'''
+    frames = [track.frames for stc in records 
+                           for tracks in stc.seq_data if tracks is not None
+                           for track in tracks if track.frames is not None and len(track.frames) > 0]
+
+    if len(frames) == 0:
+        return (0, 0)
+
+    return (int(min(f.min() for f in frames)), int(max(f.max() for f in frames)))
+
+def readSequences(filepath, names=None, filesystem=None):
+    '''Decodes the animation data of the named sequences only, all
+    sequences without names'''
+    file = M3File(filepath, filesystem)
+
+    try:
+        model = M3Header(file, MODL23.read_model).m3Model
+        index = SequenceIndex(model, file)
+
+        return index.read(index.names() if names is None else names)
+    finally:
+        file.close()
+
+
+# Size of the post-transform vertex cache the triangles are ordered for
+VERTEX_CACHE_SIZE = 16
+
+def acmr(faces, cache_size=VERTEX_CACHE_SIZE):
+    '''Average cache miss ratio, vertices transformed per triangle with a
+    FIFO vertex cache'''
+    if len(faces) == 0:
+        return 0.0
+
+    cache  = deque()
+    cached = set()
+    misses = 0
+
+    for v in np.asarray(faces).ravel().tolist():
+        if v not in cached:
+            misses += 1
+            cache.append(v)
+            cached.add(v)
+
+            if len(cache) > cache_size:
+                cached.discard(cache.popleft())
+
+    return misses / len(faces)
+
+def tipsify(faces, vertex_count, cache_size=VERTEX_CACHE_SIZE):
+    '''Returns the order of the triangles for the vertex cache, see Sander,
+    Nehab and Barczak, "Fast Triangle Reordering for Vertex Locality and
+    Reduced Overdraw", 2007'''
+    corners = np.asarray(faces, np.int64).ravel()
+    count   = len(corners) // 3
+
+    # Triangles of each vertex, as offsets into one array
+    adjacency = (np.argsort(corners, kind='stable') // 3).tolist()
+    offsets   = np.concatenate(([0], np.cumsum(np.bincount(corners, minlength=vertex_count)))).tolist()
+    live      = np.bincount(corners, minlength=vertex_count).tolist()
+    corners   = corners.tolist()
+
+    stamp    = [0] * vertex_count
+    emitted  = [False] * count
+    deadends = []
+    order    = []
+    time     = cache_size + 1
+    cursor   = 0
+    vertex   = 0 if count > 0 else -1
+
+    while vertex >= 0:
+        candidates = []
+
+        for t in adjacency[offsets[vertex]:offsets[vertex + 1]]:
+            if emitted[t]:
+                continue
+
+            emitted[t] = True
+            order.append(t)
+
+            for v in corners[3 * t:3 * t + 3]:
+                deadends.append(v)
+                candidates.append(v)
+                live[v] -= 1
+
+                if time - stamp[v] > cache_size:
+                    stamp[v] = time
+                    time    += 1
+
+        # Next fanning vertex: the candidate staying longest in the cache
+        # that still has triangles left
+        vertex   = -1
+        priority = -1
+
+        for v in candidates:
+            if live[v] > 0:
+                p = time - stamp[v] if time - stamp[v] + 2 * live[v] <= cache_size else 0
+
+                if p > priority:
+                    vertex   = v
+                    priority = p
+
+        if vertex == -1:
+            while deadends and vertex == -1:
+                v = deadends.pop()
+
+                if live[v] > 0:
+                    vertex = v
+
+        if vertex == -1:
+            while cursor < vertex_count and live[cursor] == 0:
+                cursor += 1
+
+            vertex = cursor if cursor < vertex_count else -1
+
+    return np.array(order, np.int64)
+
+def optimize_vertex_cache(faces, vertex_count, cache_size=VERTEX_CACHE_SIZE):
+    '''Reorders the triangles for the vertex cache and then the vertices by
+    their first use. Returns (triangle order, new faces, vertex order),
+    vertex order lists the old index of every new vertex.'''
+    faces       = np.asarray(faces, np.int64).reshape(-1, 3)
+    face_order  = tipsify(faces, vertex_count, cache_size)
+    faces       = faces[face_order]
+
+    (used, first) = np.unique(faces.ravel(), return_index=True)
+    unused        = np.setdiff1d(np.arange(vertex_count), used)
+    vertex_order  = np.concatenate((used[np.argsort(first, kind='stable')], unused))
+
+    remap = np.empty(vertex_count, np.int64)
+    remap[vertex_order] = np.arange(vertex_count)
+
+    return (face_order, remap[faces], vertex_order)
+
+# Conversion to glTF 2.0 binaries (.glb) without Blender. The buffers are
+# written straight from the decoded NumPy arrays.
+GLTF_FLOAT                = 5126
+GLTF_UNSIGNED_SHORT       = 5123
+GLTF_ARRAY_BUFFER         = 34962
+GLTF_ELEMENT_ARRAY_BUFFER = 34963
+
+def decode_normals(packed):
+    '''Decodes normals packed into 4 bytes, the fourth byte is the sign of
+    the bitangent'''
+    normals = packed[:, 0:3].astype(np.float32) * (2.0 / 255.0) - 1.0
+    length  = np.sqrt((normals * normals).sum(axis=1, keepdims=True))
+
+    np.divide(normals, length, out=normals, where=length > 0)
+
+    return normals
+
+def decode_uvs(uvs):
+    '''Decodes int16 UVs, the v axis points down like in glTF'''
+    return uvs.astype(np.float32) * (1.0 / 2048.0)
+
+def to_y_up(vectors):
+    # M3 is Z up, glTF is Y up
+    result = np.empty(vectors.shape, np.float32)
+    result[:, 0] =  vectors[:, 0]
+    result[:, 1] =  vectors[:, 2]
+    result[:, 2] = -vectors[:, 1]
+    return result
+
+class GLTFWriter:
+
+    def __init__(self, name):
+        self.gltf = {'asset'       : {'version': '2.0', 'generator': 'blendm3'},
+                     'scene'       : 0,
+                     'scenes'      : [{'nodes': [0]}],
+                     'nodes'       : [{'name': name, 'mesh': 0}],
+                     'meshes'      : [{'name': name, 'primitives': []}],
+                     'materials'   : [],
+                     'textures'    : [],
+                     'images'      : [],
+                     'samplers'    : [{}],
+                     'accessors'   : [],
+                     'bufferViews' : [],
+                     'buffers'     : []}
+        self.arrays   = []
+        self.length   = 0
+        self.images   = {}
+        
+    def add_view(self, array, target):
+        array = np.ascontiguousarray(array)
+        
+        self.gltf['bufferViews'].append({'buffer'    : 0,
+                                         'byteOffset': self.length,
+                                         'byteLength': array.nbytes,
+                                         'target'    : target})
+        self.arrays.append(array)
+        
+        # Views are aligned to 4 bytes
+        self.length += array.nbytes
+        padding = -self.length % 4
+
+        if padding:
+            self.arrays.append(np.zeros(padding, np.uint8))
+            self.length += padding
+
+        return len(self.gltf['bufferViews']) - 1
+
+    def add_accessor(self, view, offset, component, count, type, minimum=None, maximum=None):
+        accessor = {'bufferView'   : view,
+                    'byteOffset'   : offset,
+                    'componentType': component,
+                    'count'        : count,
+                    'type'         : type}
+
+        if minimum is not None:
+            accessor['min'] = [float(x) for x in minimum]
+            accessor['max'] = [float(x) for x in maximum]
+
+        self.gltf['accessors'].append(accessor)
+        return len(self.gltf['accessors']) - 1
+
+    def add_texture(self, path, texture_ext):
+        uri = path.replace("\\", "/")
+
+        if texture_ext:
+            uri = os.path.splitext(uri)[0] + texture_ext
+
+        if uri not in self.images:
+            self.gltf['images'].append({'uri': quote(uri)})
+            self.gltf['textures'].append({'source': len(self.gltf['images']) - 1, 'sampler': 0})
+            self.images[uri] = len(self.gltf['textures']) - 1
+
+        return {'index': self.images[uri]}
+
+    def add_material(self, material, texture_ext):
+        pbr   = {'metallicFactor': 0.0, 'roughnessFactor': 1.0}
+        entry = {'name': material.Name, 'pbrMetallicRoughness': pbr}
+
+        if 'DIFFUSIVE' in material.Layers:
+            pbr['baseColorTexture'] = self.add_texture(material.Layers['DIFFUSIVE'].Path, texture_ext)
+
+        if 'NORMAL' in material.Layers:
+            entry['normalTexture'] = self.add_texture(material.Layers['NORMAL'].Path, texture_ext)
+
+        if 'EMISSIVE' in material.Layers:
+            entry['emissiveTexture'] = self.add_texture(material.Layers['EMISSIVE'].Path, texture_ext)
+            entry['emissiveFactor']  = [1.0, 1.0, 1.0]
+
+        if material.BlendMode in (MAT.BLEND_MODE['ALPHA_BLEND'], MAT.BLEND_MODE['ALPHA_ADD']):
+            entry['alphaMode'] = 'BLEND'
+
+        if material.flags['TWO_SIDED']:
+            entry['doubleSided'] = True
+
+        self.gltf['materials'].append(entry)
+        return len(self.gltf['materials']) - 1
+
+    def write(self, filepath):
+        self.gltf['buffers'].append({'byteLength': self.length})
+
+        # Empty top level arrays are not allowed
+        for key in [key for key, value in self.gltf.items() if value == []]:
+            del self.gltf[key]
+
+        document = json.dumps(self.gltf, separators=(',', ':')).encode("utf-8")
+        document += b' ' * (-len(document) % 4)
+
+        with open(filepath, "wb") as f:
+            f.write(pack("<4sII", b'glTF', 2, 12 + 8 + len(document) + 8 + self.length))
+            f.write(pack("<I4s", len(document), b'JSON'))
+            f.write(document)
+            f.write(pack("<I4s", self.length, b'BIN\0'))
+
+            for array in self.arrays:
+                f.write(array.data)
+
+def optimize_regions(div, indices, attributes, cache_size, name):
+    '''Reorders the faces and vertices of the regions used by the batches,
+    the vertex attributes are permuted in place. Returns the new indices.'''
+    indices = np.array(indices)
+    faces   = 0
+    before  = 0.0
+    after   = 0.0
+
+    for index in sorted({bat.REGN_Index for bat in div.Bat}):
+        regn  = div.Regions[index]
+        first = regn.OffsetVert
+        last  = regn.OffsetVert + regn.NumVert
+        local = indices[regn.OffsetFaces:regn.OffsetFaces + regn.NumFaces].reshape(-1, 3)
+
+        faces  += len(local)
+        before += acmr(local, cache_size) * len(local)
+
+        (face_order, optimized, vertex_order) = optimize_vertex_cache(local, regn.NumVert, cache_size)
+
+        for attribute in attributes:
+            attribute[first:last] = attribute[first:last][vertex_order]
+
+        indices[regn.OffsetFaces:regn.OffsetFaces + regn.NumFaces] = optimized.ravel()
+        after += acmr(optimized, cache_size) * len(local)
+
+    if faces > 0:
+        print("Vertex cache miss ratio of %s %.3f before, %.3f after reordering" % (name, before / faces, after / faces))
+
+    return indices
+
+def convert_to_gltf(filepath, output, texture_ext=None, cache_size=0):
+    '''Converts a .m3 model into a glTF binary with one primitive per
+    batch. A cache_size above zero reorders the faces and vertices of
+    every region for a vertex cache of that size.'''
+    filesystem = VirtualFileSystem()
+    file       = M3File(filepath, filesystem)
+
+    try:
+        model    = M3Header(file, MODL23.read_model).m3Model
+        vertices = model.read_vertices(file, 0, model.VertexCount)
+        indices  = model.Div.read_indices(file, 0, model.Div.Indices.Count)
+    finally:
+        file.close()
+        filesystem.close()
+
+    writer = GLTFWriter(model.name or basename(filepath))
+    div    = model.Div
+
+    positions = to_y_up(vertices.positions())
+    normals   = to_y_up(vertices.normals())
+    uvs       = vertices.uvs()
+
+    if cache_size > 0:
+        indices = optimize_regions(div, indices, (positions, normals, uvs), cache_size, filepath)
+
+    position_view = writer.add_view(positions, GLTF_ARRAY_BUFFER)
+    normal_view   = writer.add_view(normals, GLTF_ARRAY_BUFFER)
+    uv_views      = [writer.add_view(uvs[:, i], GLTF_ARRAY_BUFFER) for i in range(uvs.shape[1])]
+    index_view    = writer.add_view(indices, GLTF_ELEMENT_ARRAY_BUFFER)
+
+    # Accessors of a region start at its first vertex, the face indices of
+    # M3 regions are relative to that vertex
+    regions   = {}
+    materials = {}
+
+    for bat in div.Bat:
+        regn = div.Regions[bat.REGN_Index]
+
+        if bat.REGN_Index not in regions:
+            first = regn.OffsetVert
+            last  = regn.OffsetVert + regn.NumVert
             
-        reference_table_offset = file.read_uint()
-        reference_table_count  = file.read_uint()
-        model_count            = file.read_uint()
-        model_index            = file.read_uint()
-        
-        file.seek(reference_table_offset)
-        
-        # Creating reference table
-        for i in range(reference_table_count):
-            file.ReferenceTable.append(M3ReferenceEntry(file))
+            attributes = {'POSITION': writer.add_accessor(position_view, first * 12, GLTF_FLOAT, regn.NumVert, 'VEC3',
+                                                          positions[first:last].min(axis=0), positions[first:last].max(axis=0)),
+                          'NORMAL'  : writer.add_accessor(normal_view, first * 12, GLTF_FLOAT, regn.NumVert, 'VEC3')}
+
+            for i, view in enumerate(uv_views):
+                attributes['TEXCOORD_%d' % i] = writer.add_accessor(view, first * 8, GLTF_FLOAT, regn.NumVert, 'VEC2')
+
+            regions[bat.REGN_Index] = attributes
             
-        # Creating models
-        modelReference = file.ReferenceTable[model_index]
-        
-        if (modelReference.Type != 23):
-            raise Exception('import_m3: !ERROR! Unsupported model format: %s' % hex(modelReference.Type))
+        primitive = {'attributes': regions[bat.REGN_Index],
+                     'indices'   : writer.add_accessor(index_view, regn.OffsetFaces * 2, GLTF_UNSIGNED_SHORT, regn.NumFaces, 'SCALAR')}
 
-        file.seek(modelReference.Offset)
-        
-        assert(modelReference.Count == 1)
-        self.m3Model = MODL23.read(file)
+        lookup = model.MaterialLookup[bat.MAT_Index]
+
+        if lookup.material_type == 'MAT':
+            if lookup.MaterialIndex not in materials:
+                materials[lookup.MaterialIndex] = writer.add_material(model.Materials[lookup.MaterialIndex], texture_ext)
+
+            primitive['material'] = materials[lookup.MaterialIndex]
+
+        writer.gltf['meshes'][0]['primitives'].append(primitive)
+
+    writer.write(output)
+    return output
 
 def createArmatures(bones, irefs):
     bpy.ops.object.add(
@@ -743,59 +2207,164 @@ def createArmatures(bones, irefs):
     #for i, b in enumerate(bone_list):
     #    if b.parent is not None:
     #        b.tail = b.parent.head
-def createNodeMaterial(material):
+# Layers wired into the node groups of the material archetypes
+NODE_LAYERS = ('DIFFUSIVE', 'NORMAL', 'EMISSIVE')
+
+# Values of the group inputs left unlinked when a texture is missing: white
+# and opaque, a flat normal and no emission
+NODE_SOCKET_DEFAULTS = {'Diffusive': (1.0, 1.0, 1.0, 1.0),
+                        'Normal'   : (0.5, 0.5, 1.0, 1.0),
+                        'Emissive' : (0.0, 0.0, 0.0, 1.0),
+                        'Alpha'    : 1.0}
+
+def material_archetype(material):
+    '''Returns the name of the node group shared by all materials with the
+    same layers and blend mode'''
+    layers = [key for key in NODE_LAYERS if key in material.Layers]
+    blend  = {value: key for key, value in MAT.BLEND_MODE.items()}.get(material.BlendMode, 'OPAQUE')
+
+    return "M3 %s %s" % (blend, "+".join(layers) or "UNTEXTURED")
+
+def addGroupSocket(group, in_out, socket_type, name):
+    # Blender 4.0 moved the sockets of node groups into the interface
+    if hasattr(group, 'interface'):
+        socket = group.interface.new_socket(name, in_out=in_out, socket_type=socket_type)
+    elif in_out == 'INPUT':
+        socket = group.inputs.new(socket_type, name)
+    else:
+        socket = group.outputs.new(socket_type, name)
+
+    if in_out == 'INPUT' and name in NODE_SOCKET_DEFAULTS:
+        socket.default_value = NODE_SOCKET_DEFAULTS[name]
+
+    return socket
+
+def createNodeGroup(material):
+    '''Returns the node group of the material archetype, the group is
+    built once and only the images differ between its materials'''
+    name  = material_archetype(material)
+    group = bpy.data.node_groups.get(name)
+
+    if group is not None:
+        return group
+
+    group = bpy.data.node_groups.new(name, 'ShaderNodeTree')
+    nodes = group.nodes
+    links = group.links
+
+    for key in NODE_LAYERS:
+        if key in material.Layers:
+            addGroupSocket(group, 'INPUT', 'NodeSocketColor', key.title())
+
+    if 'DIFFUSIVE' in material.Layers:
+        addGroupSocket(group, 'INPUT', 'NodeSocketFloat', 'Alpha')
+
+    addGroupSocket(group, 'OUTPUT', 'NodeSocketShader', 'Shader')
+
+    inputs  = nodes.new('NodeGroupInput')
+    outputs = nodes.new('NodeGroupOutput')
+    blend   = material.BlendMode
+
+    if blend in (MAT.BLEND_MODE['ADD'], MAT.BLEND_MODE['ALPHA_ADD']):
+        # Additive materials only add light
+        transparent = nodes.new('ShaderNodeBsdfTransparent')
+        glow        = nodes.new('ShaderNodeEmission')
+        add         = nodes.new('ShaderNodeAddShader')
+
+        if 'DIFFUSIVE' in material.Layers:
+            links.new(inputs.outputs['Diffusive'], glow.inputs['Color'])
+
+        links.new(transparent.outputs['BSDF'], add.inputs[0])
+        links.new(glow.outputs['Emission'], add.inputs[1])
+        shader = add.outputs['Shader']
+    elif blend in (MAT.BLEND_MODE['MOD'], MAT.BLEND_MODE['MOD2X']):
+        # Modulating materials multiply what is behind them
+        transparent = nodes.new('ShaderNodeBsdfTransparent')
+
+        if 'DIFFUSIVE' in material.Layers:
+            links.new(inputs.outputs['Diffusive'], transparent.inputs['Color'])
+
+        shader = transparent.outputs['BSDF']
+    else:
+        bsdf   = nodes.new('ShaderNodeBsdfPrincipled')
+        shader = bsdf.outputs['BSDF']
+
+        if 'DIFFUSIVE' in material.Layers:
+            links.new(inputs.outputs['Diffusive'], bsdf.inputs['Base Color'])
+
+        if 'NORMAL' in material.Layers:
+            normal_map = nodes.new('ShaderNodeNormalMap')
+            links.new(inputs.outputs['Normal'], normal_map.inputs['Color'])
+            links.new(normal_map.outputs['Normal'], bsdf.inputs['Normal'])
+
+        if 'EMISSIVE' in material.Layers:
+            emission = nodes.new('ShaderNodeEmission')
+            emission.inputs['Strength'].default_value = 2.0
+            links.new(inputs.outputs['Emissive'], emission.inputs['Color'])
+
+            add = nodes.new('ShaderNodeAddShader')
+            links.new(shader, add.inputs[0])
+            links.new(emission.outputs['Emission'], add.inputs[1])
+            shader = add.outputs['Shader']
+
+        if blend == MAT.BLEND_MODE['ALPHA_BLEND'] and 'DIFFUSIVE' in material.Layers:
+            transparent = nodes.new('ShaderNodeBsdfTransparent')
+            mix         = nodes.new('ShaderNodeMixShader')
+            links.new(inputs.outputs['Alpha'], mix.inputs['Fac'])
+            links.new(transparent.outputs['BSDF'], mix.inputs[1])
+            links.new(shader, mix.inputs[2])
+            shader = mix.outputs['Shader']
+
+    links.new(shader, outputs.inputs['Shader'])
+
+    return group
+
+def createNodeMaterial(material, filesystem=None):
+    '''Creates the material as an instance of the node group of its
+    archetype, only the images are set per material'''
     mat = bpy.data.materials.new(material.Name)
     mat.use_nodes = True
 
-    diffuse_bsdf = mat.node_tree.nodes['Diffuse BSDF']
-    material_out = mat.node_tree.nodes['Material Output']
+    nodes = mat.node_tree.nodes
+    links = mat.node_tree.links
+    nodes.clear()
 
-    for key in material.Layers.keys():
-        print("Material: ", key, " Path: ", material.Layers[key].Path)
+    group = nodes.new('ShaderNodeGroup')
+    group.node_tree = createNodeGroup(material)
 
-    # Diffusive
-    if ('DIFFUSIVE' in material.Layers):
-        layer = material.Layers['DIFFUSIVE']
-        tex = createTexture(material.Name + "_DIFFUSIVE", layer.Path)
-    
-        if tex is not None:
-            node = mat.node_tree.nodes.new('ShaderNodeTexImage')
-            node.image = tex.image
-            mat.node_tree.links.new(diffuse_bsdf.inputs['Color'], node.outputs['Color'])
+    # Groups already in the file may have been created without defaults
+    for (name, value) in NODE_SOCKET_DEFAULTS.items():
+        if name in group.inputs:
+            group.inputs[name].default_value = value
 
-    # Normal
-    if ('NORMAL' in material.Layers):
-        layer = material.Layers['NORMAL']
-        tex = createTexture(material.Name + "_NORMAL", layer.Path)
-    
-        if tex is not None:
-            node = mat.node_tree.nodes.new('ShaderNodeTexImage')
-            node.image = tex.image
-            mat.node_tree.links.new(diffuse_bsdf.inputs['Normal'], node.outputs['Color'])
-        
+    material_out = nodes.new('ShaderNodeOutputMaterial')
+    links.new(group.outputs['Shader'], material_out.inputs['Surface'])
 
-    # Emissive
-    if ('EMISSIVE' in material.Layers):
-        layer = material.Layers['EMISSIVE']
-        tex = createTexture(material.Name + "_EMISSIVE", layer.Path)
+    for key in NODE_LAYERS:
+        if key not in material.Layers:
+            continue
+
+        tex = createTexture(material.Name + "_" + key, material.Layers[key].Path, filesystem)
 
         if tex is not None:
-            node = mat.node_tree.nodes.new('ShaderNodeTexImage')
-            emissive = mat.node_tree.nodes.new('ShaderNodeEmission')
+            node = nodes.new('ShaderNodeTexImage')
             node.image = tex.image
-            mat.node_tree.links.new(emissive.inputs['Color'], node.outputs['Color'])
-            mixer = mat.node_tree.nodes.new('ShaderNodeMixShader')
-            mat.node_tree.links.new(emissive.outputs['Emission'], mixer.inputs[2])
-            mat.node_tree.links.new(diffuse_bsdf.outputs['BSDF'], mixer.inputs[1])
-            mat.node_tree.links.new(mixer.outputs['Shader'], material_out.inputs['Surface'])
-            emissive.inputs['Strength'].default_value = 2.0
 
-    # Emissive and Mixer Node
+            if key == 'NORMAL':
+                node.image.colorspace_settings.name = 'Non-Color'
+
+            links.new(node.outputs['Color'], group.inputs[key.title()])
+
+            if key == 'DIFFUSIVE':
+                links.new(node.outputs['Alpha'], group.inputs['Alpha'])
+
+    if material.BlendMode != MAT.BLEND_MODE['OPAQUE'] and hasattr(mat, 'blend_method'):
+        mat.blend_method = 'BLEND'
 
     return mat
 
 
-def createMaterial(material):
+def createMaterial(material, filesystem=None):
     mat = bpy.data.materials.new(material.Name)
     
     # Material options
@@ -811,7 +2380,7 @@ def createMaterial(material):
     #=============================================================
     if ('DIFFUSIVE' in material.Layers):
         layer = material.Layers['DIFFUSIVE']
-        tex = createTexture(material.Name + "_DIFFUSIVE", layer.Path)
+        tex = createTexture(material.Name + "_DIFFUSIVE", layer.Path, filesystem)
 
         if tex is not None:
             tex.use_alpha = False
@@ -827,7 +2396,7 @@ def createMaterial(material):
     #=============================================================
     if ('DECAL' in material.Layers):
         layer = material.Layers['DECAL']
-        tex = createTexture(material.Name + "_DECAL", layer.Path)
+        tex = createTexture(material.Name + "_DECAL", layer.Path, filesystem)
 
         if tex is not None:
             tex.use_alpha             = True
@@ -846,7 +2415,7 @@ def createMaterial(material):
     #==============================================================
     if ('SPECULAR in material.Layers'):
         layer  = material.Layers['SPECULAR']
-        tex = createTexture(material.Name + "_SPECULAR", layer.Path)
+        tex = createTexture(material.Name + "_SPECULAR", layer.Path, filesystem)
 
         if tex is not None:
             tex.use_alpha = False
@@ -864,7 +2433,7 @@ def createMaterial(material):
     #==============================================================
     if ('NORMAL' in material.Layers):
         layer = material.Layers['NORMAL']
-        tex = createTexture(material.Name + "_NORMAL", layer.Path)
+        tex = createTexture(material.Name + "_NORMAL", layer.Path, filesystem)
 
         if tex is not None:
             slot = mat.texture_slots.add()
@@ -878,7 +2447,7 @@ def createMaterial(material):
     #=============================================================
     #emissive_layer = material.Layers['EMISSIVE_COLOR']
 
-    #tex = createTexture(material.Name + "_EMISSIVE_COLOR", layer.Path)
+    #tex = createTexture(material.Name + "_EMISSIVE_COLOR", layer.Path, filesystem)
     #tex.use_calculate_alpha = True
     #tex.use_alpha           = True
     
@@ -893,7 +2462,7 @@ def createMaterial(material):
     #=============================================================
     if ('EMISSIVE' in material.Layers):
         layer = material.Layers['EMISSIVE']
-        tex = createTexture(material.Name + "_EMISSIVE", layer.Path)
+        tex = createTexture(material.Name + "_EMISSIVE", layer.Path, filesystem)
 
         if tex is not None:
             tex.use_calculate_alpha = True
@@ -907,39 +2476,278 @@ def createMaterial(material):
     
     return mat
 
-def findImage(image_path):
-    '''Finds the image on the file system and returns the path, if the
-    file exists'''
-    filename = basename(image_path)
+def findImage(image_path, filesystem=None):
+    '''Finds the image in the virtual file system and returns the located
+    file, if the image exists'''
+    if filesystem is None:
+        filesystem = VirtualFileSystem(["."])
+
+    return filesystem.find(image_path)
+
+# DDS header up to the pixel format, see the DDS_HEADER documentation
+DDS_HEADER = Struct('<4s7I44x2I4s5I')
+
+def expand_565(colors):
+    '''Expands R5G6B5 colors into (..., 3) uint16 RGB'''
+    colors = colors.astype(np.uint16)
+    r = (colors >> 11) & 0x1f
+    g = (colors >> 5) & 0x3f
+    b = colors & 0x1f
+    return np.stack(((r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)), axis=-1)
+
+def decode_color_blocks(blocks, four_colors):
+    '''Decodes (n, 8) DXT color blocks into (n, 16, 4) RGBA pixels'''
+    endpoints = np.ascontiguousarray(blocks[:, 0:4]).view('<u2')
+    colors    = expand_565(endpoints)
+    c0        = colors[:, 0]
+    c1        = colors[:, 1]
+    
+    palette = np.empty((len(blocks), 4, 4), np.uint16)
+    palette[:, :, 3] = 255
+    palette[:, 0, 0:3] = c0
+    palette[:, 1, 0:3] = c1
+    palette[:, 2, 0:3] = (2 * c0 + c1) // 3
+    palette[:, 3, 0:3] = (c0 + 2 * c1) // 3
+
+    if not four_colors:
+        # DXT1 blocks with c0 <= c1 have three colors and transparent black
+        three = endpoints[:, 0] <= endpoints[:, 1]
+        palette[three, 2, 0:3] = (c0[three] + c1[three]) // 2
+        palette[three, 3]      = 0
+
+    bits    = np.ascontiguousarray(blocks[:, 4:8]).view('<u4')
+    indices = (bits >> (2 * np.arange(16, dtype=np.uint32))) & 3
+    
+    return palette[np.arange(len(blocks))[:, None], indices].astype(np.uint8)
+
+def decode_alpha_blocks(blocks):
+    '''Decodes (n, 8) DXT5 alpha blocks into (n, 16) alpha values'''
+    a0 = blocks[:, 0].astype(np.uint16)[:, None]
+    a1 = blocks[:, 1].astype(np.uint16)[:, None]
+    i  = np.arange(1, 7, dtype=np.uint16)[None, :]
     
-    if os.path.isfile(image_path):
-        return image_path
+    # Eight interpolated values if a0 > a1, six and 0 and 255 otherwise
+    palette = np.where(a0 > a1, 
+                       np.hstack((a0, a1, ((7 - i) * a0 + i * a1) // 7)),
+                       np.hstack((a0, a1, ((5 - i[:, 0:4]) * a0 + i[:, 0:4] * a1) // 5,
+                                  np.zeros_like(a0), np.full_like(a0, 255))))
+
+    bits    = np.zeros((len(blocks), 8), np.uint8)
+    bits[:, 0:6] = blocks[:, 2:8]
+    bits    = bits.view('<u8')
+    indices = (bits >> (3 * np.arange(16, dtype=np.uint64))) & 7
+
+    return palette[np.arange(len(blocks))[:, None], indices.astype(np.intp)].astype(np.uint8)
+
+def decode_dds(data, min_size=0):
+    '''Decodes a DXT1, DXT5 or 32 bit DDS image into (height, width, 4) RGBA
+    pixels. The smallest stored mip level of at least min_size pixels is
+    decoded. Returns None for unsupported formats.'''
+    if len(data) < 128:
+        return None
+
+    (magic, size, flags, height, width, pitch, depth, mips, 
+     pf_size, pf_flags, fourcc, bits, r_mask, g_mask, b_mask, a_mask) = DDS_HEADER.unpack_from(data, 0)
+
+    if magic != b'DDS ':
+        return None
+
+    if fourcc == b'DXT1':
+        block_size = 8
+    elif fourcc == b'DXT5':
+        block_size = 16
+    elif pf_flags & 0x40 and bits == 32:
+        block_size = None
+    else:
+        return None
 
-    # Search for filename in all subdirectories
-    for prefix, directories, files in os.walk("."):
-        if filename in files:
-            return prefix + "/" + filename
+    offset = 128
 
-    return None
+    for level in range(max(1, mips)):
+        if block_size is not None:
+            length = max(1, (width + 3) // 4) * max(1, (height + 3) // 4) * block_size
+        else:
+            length = width * height * 4
+
+        last = (level + 1 >= max(1, mips)) or max(width // 2, height // 2) < min_size
+
+        if last:
+            break
+
+        offset += length
+        width   = max(1, width // 2)
+        height  = max(1, height // 2)
+
+    level = np.frombuffer(data, np.uint8, length, offset)
+
+    if block_size is None:
+        values = level.view('<u4')
+        pixels = np.empty((height * width, 4), np.uint8)
+
+        for channel, mask in enumerate((r_mask, g_mask, b_mask, a_mask)):
+            if mask == 0:
+                pixels[:, channel] = 255
+            else:
+                shift = (mask & -mask).bit_length() - 1
+                pixels[:, channel] = ((values & mask) >> shift) * 255 // (mask >> shift)
+
+        return pixels.reshape(height, width, 4)
+
+    blocks = level.reshape(-1, block_size)
+
+    if block_size == 8:
+        pixels = decode_color_blocks(blocks, False)
+    else:
+        pixels = decode_color_blocks(blocks[:, 8:16], True)
+        pixels[:, :, 3] = decode_alpha_blocks(blocks[:, 0:8])
+
+    # Blocks of 4x4 pixels back into rows
+    bw = max(1, (width + 3) // 4)
+    bh = max(1, (height + 3) // 4)
+    pixels = pixels.reshape(bh, bw, 4, 4, 4).transpose(0, 2, 1, 3, 4).reshape(bh * 4, bw * 4, 4)
+
+    return pixels[0:height, 0:width]
+
+def box_filter(pixels):
+    '''Halves the resolution of the image by averaging 2x2 pixels'''
+    (height, width) = pixels.shape[0:2]
+    fy = 2 if height > 1 else 1
+    fx = 2 if width > 1 else 1
+
+    pixels = pixels[0:height - height % fy, 0:width - width % fx].astype(np.uint16)
+    pixels = pixels.reshape(height // fy, fy, width // fx, fx, 4).sum(axis=(1, 3))
+
+    return ((pixels + (fy * fx) // 2) // (fy * fx)).astype(np.uint8)
+
+def write_png(path, pixels):
+    '''Writes (height, width, 4) RGBA pixels as PNG'''
+    (height, width) = pixels.shape[0:2]
     
-def createTexture(name, filepath):
-        realpath = os.path.abspath(filepath)
-        realpath = os.path.normpath(realpath)
+    # Every row starts with filter type 0
+    rows = np.zeros((height, width * 4 + 1), np.uint8)
+    rows[:, 1:] = pixels.reshape(height, width * 4)
+
+    def chunk(tag, data):
+        return pack('>I', len(data)) + tag + data + pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    with open(path, "wb") as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', pack('>2I5B', width, height, 8, 6, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+# Default directory of the proxy texture cache
+TEXTURE_PROXY_CACHE = os.path.join(tempfile.gettempdir(), "blendm3_proxies")
+
+# Cache of downscaled copies of the textures, used in the viewport in place
+# of the full resolution textures. Proxies are keyed by the hash of the
+# source, so they are shared by all models and survive Blender restarts.
+class TextureProxyCache:
+
+    def __init__(self, size, directory=TEXTURE_PROXY_CACHE):
+        self.size      = size
+        self.directory = directory
+        # Results by image name, the source is read and hashed only once
+        # per import
+        self.results   = {}
+
+        os.makedirs(directory, exist_ok=True)
+
+    def full_resolution(self, image, key, data):
+        '''Returns a disk path of the source, images inside bundles are
+        copied into the cache'''
+        if image.path is not None:
+            return image.path
+
+        path = os.path.join(self.directory, key + os.path.splitext(image.name)[1])
+
+        if not os.path.isfile(path):
+            self.write(path, lambda f: f.write(data))
+
+        return path
+
+    def write(self, path, writer):
+        # Written under a temporary name, concurrent imports never see
+        # partial files
+        temp = "%s.%d.%d.tmp" % (path, os.getpid(), id(writer))
+
+        try:
+            if isinstance(writer, np.ndarray):
+                write_png(temp, writer)
+            else:
+                with open(temp, "wb") as f:
+                    writer(f)
+
+            os.replace(temp, path)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def proxy(self, image):
+        '''Returns (proxy path, full resolution path) of the located image
+        file or None if the format is not supported'''
+        if image.name not in self.results:
+            try:
+                self.results[image.name] = self.create(image)
+            except Exception as err:
+                # Broken sources are loaded at full resolution
+                print("Cannot create proxy texture: %s (%s)" % (image.name, str(err)))
+                self.results[image.name] = None
+
+        return self.results[image.name]
 
-        imagepath = findImage(realpath)
+    def create(self, image):
+        data  = image.read()
+        key   = content_hash(data)
+        path  = os.path.join(self.directory, "%s_%d.png" % (key, self.size))
+        
+        if not os.path.isfile(path):
+            pixels = decode_dds(data, self.size)
+
+            if pixels is None:
+                return None
+
+            while max(pixels.shape[0:2]) > self.size:
+                pixels = box_filter(pixels)
 
-        if imagepath:
+            self.write(path, pixels)
+
+        return (path, self.full_resolution(image, key, data))
+
+def createTexture(name, filepath, filesystem=None):
+        image = findImage(filepath, filesystem)
+
+        if image:
             tex = bpy.data.textures.new(name, 'IMAGE')
         
             try:
-                tex.image = bpy.data.images.load(imagepath)
-                print("Importing image: %s ok." % imagepath)
+                proxy = None
+
+                if filesystem is not None and filesystem.proxies is not None:
+                    proxy = filesystem.proxies.proxy(image)
+
+                if proxy is not None:
+                    # Full resolution is swapped in for final renders
+                    tex.image = bpy.data.images.load(proxy[0], check_existing=True)
+                    tex.image["m3_proxy"]           = proxy[0]
+                    tex.image["m3_full_resolution"] = proxy[1]
+                elif image.path is not None:
+                    tex.image = bpy.data.images.load(image.path)
+                else:
+                    # Image inside a bundle, decoded from memory and packed
+                    # into the .blend file
+                    data = image.read()
+                    tex.image = bpy.data.images.new(basename(image.name), 1, 1)
+                    tex.image.pack(data=data, data_len=len(data))
+                    tex.image.source = 'FILE'
+
+                print("Importing image: %s ok." % image.name)
 
             except Exception as err:
-                print("Cannot load texture: %s (%s)" % (realpath, str(err))) 
+                print("Cannot load texture: %s (%s)" % (image.name, str(err))) 
                 return None
         else:
-            print("Importing image: %s failed." % basename(realpath))
+            print("Importing image: %s failed." % basename(filepath))
             return None
         
         return tex
@@ -948,116 +2756,1061 @@ class Submesh:
 
     def __init__(self, vertices, faces, material, iref, bones):
         self.Name = "NONAME"
-        self.Vertices = []
-        # TODO: maybe better to unflatten here instead of in calling function
+        # Quantized vertices, positions and (face count, 3) vertex indices
+        self.vertices = vertices
+        self.Vertices = vertices.positions()
         self.Faces = faces
-        self.UV = []
+        
+        # Packed normals, see CompactVertices.normals
+        self.Normals = vertices.data['Normal']
         
         self.Material = material
         self.bones = bones
         self.iref = iref
-        
-        # position in vertices array
-        for v in vertices:
-            self.Vertices.append(v.Position)
-            
-        for i, f in enumerate(self.Faces):
-            #self.UV1.append(((vertices[f[0]].UV[0]), (vertices[f[1]].UV[0]), (vertices[f[2]].UV[0])))
-            
-            
-            self.UV.append(((vertices[f[0]].UV), (vertices[f[1]].UV), (vertices[f[2]].UV)))
 
-def load(context, filepath, import_material, search_textures):
-    file = M3File(filepath)
-        
-    # Reading file header
-    m3Header = M3Header(file)
-
-    name = basename(filepath)
-    index = filepath.rfind('Assets')
-    if search_textures == True and index is not -1:
-        workdir = filepath[0:index]
-        os.chdir(workdir)
-    else:
-        os.chdir(os.path.dirname(filepath))
+        # Material slots of the mesh, all faces use the first one
+        self.Materials = [material]
+        self.MaterialIndices = None
 
-    for submesh in m3Header.m3Model:
-        mesh = bpy.data.meshes.new(name)
-        mesh.from_pydata(submesh.Vertices, [], submesh.Faces)
-        
-        mesh.uv_textures.new()
-        mesh.uv_textures.new()
-        mesh.uv_textures.new()
-        mesh.uv_textures.new()
-        mesh.uv_textures[0].name = 'UV_0'
-        mesh.uv_textures[1].name = 'UV_1'
-        mesh.uv_textures[2].name = 'UV_2'
-        mesh.uv_textures[3].name = 'UV_3'
-
-        for i, face in enumerate(submesh.UV):
-            for l in range(len(face[0])):
-                data = mesh.uv_layers[l].data[i]
-                mesh.uv_layers[l].data[i*3 + 0].uv = face[0][l]
-                mesh.uv_layers[l].data[i*3 + 1].uv = face[1][l]
-                mesh.uv_layers[l].data[i*3 + 2].uv = face[2][l]
-        
-        mesh.update(True)
-        ob = bpy.data.objects.new(name, mesh)
-        
-        if import_material:
-            if bpy.context.scene.render.engine == 'BLENDER_RENDER':
-                mat = createMaterial(submesh.Material)
-                ob.data.materials.append(mat)
-            elif bpy.context.scene.render.engine == 'CYCLES':
-                mat = createNodeMaterial(submesh.Material)
-                ob.data.materials.append(mat)
-            
-        #createArmatures(submesh.bones, submesh.iref)
-            
-        #for f in ob.data.faces:
-        #    print(f.material_index)
-        #    print(f.index)
+    @property
+    def UV(self):
+        '''UV per vertex and UV layer, the v axis is flipped for Blender'''
+        return self.vertices.uvs(flip_v=True)
+
+    def corner_uvs(self):
+        '''Returns the UVs per face corner'''
+        return self.UV[np.asarray(self.Faces).ravel()]
+
+    def optimize_cache(self, cache_size=VERTEX_CACHE_SIZE):
+        '''Reorders the faces for the vertex cache and the vertices for
+        fetch locality. The hashes are kept, they describe the file.'''
+        before = acmr(self.Faces, cache_size)
+
+        (face_order, faces, vertex_order) = optimize_vertex_cache(self.Faces, len(self.Vertices), cache_size)
+
+        self.vertices = self.vertices[vertex_order]
+        self.Vertices = self.vertices.positions()
+        self.Normals  = self.vertices.data['Normal']
+        self.Faces    = faces
+
+        if self.MaterialIndices is not None:
+            self.MaterialIndices = self.MaterialIndices[face_order]
+
+        self.ACMR = (before, acmr(faces, cache_size))
+
+# Submeshes of a model merged into one mesh with a shared vertex set.
+# Vertices are merged by their position quantized to the weld distance
+# and optionally their normal. UVs are kept per face corner, so UV seams
+# survive the merge.
+class WeldedMesh:
+
+    def __init__(self, submeshes, distance=0.0001, use_normals=False):
+        positions = []
+        normals   = []
+        faces     = []
+        uvs       = []
+        indices   = []
         
-        context.scene.objects.link(ob)
+        self.Materials = []
+        materials      = {}
+        hashes         = []
+        offset         = 0
+
+        for submesh in submeshes:
+            # Submeshes share the material records of the model
+            if id(submesh.Material) not in materials:
+                materials[id(submesh.Material)] = len(self.Materials)
+                self.Materials.append(submesh.Material)
+
+            positions.append(submesh.Vertices)
+            normals.append(submesh.Normals[:, 0:3])
+            faces.append(np.asarray(submesh.Faces, np.int64) + offset)
+            uvs.append(submesh.corner_uvs())
+            indices.append(np.full(len(submesh.Faces), materials[id(submesh.Material)], np.int32))
+            hashes.append((submesh.VertexHash, submesh.TopologyHash, submesh.MaterialHash))
+
+            offset += len(submesh.Vertices)
+
+        if len(positions) == 0:
+            # Nothing selected, the welded mesh stays empty
+            positions.append(np.zeros((0, 3), np.float32))
+            normals.append(np.zeros((0, 3), np.uint8))
+            faces.append(np.zeros((0, 3), np.int64))
+            uvs.append(np.zeros((0, 1, 2), np.float32))
+            indices.append(np.zeros(0, np.int32))
+
+        positions = np.concatenate(positions)
+        faces     = np.concatenate(faces)
+        
+        if distance > 0:
+            keys = np.round(positions / distance).astype(np.int64)
+        else:
+            keys = positions
+
+        if use_normals:
+            keys = np.hstack((keys, np.concatenate(normals).astype(keys.dtype)))
+
+        (unique, first, inverse) = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+
+        faces = inverse.reshape(-1)[faces]
+
+        # Faces collapsed by the merge are dropped
+        keep = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+        uvs  = np.concatenate(uvs)
+
+        self.Name            = "NONAME"
+        self.Vertices        = positions[first]
+        self.Faces           = faces[keep]
+        self.UV              = uvs.reshape(len(faces), 3, *uvs.shape[1:])[keep].reshape(-1, *uvs.shape[1:])
+        self.MaterialIndices = np.concatenate(indices)[keep]
+        self.Material        = self.Materials[0] if self.Materials else None
+
+        self.Bat          = -1
+        self.Region       = -1
+        self.VertexHash   = content_hash(repr([h[0] for h in hashes]).encode("utf-8"))
+        self.TopologyHash = content_hash(repr([h[1] for h in hashes]).encode("utf-8"))
+        self.MaterialHash = content_hash(repr([h[2] for h in hashes]).encode("utf-8"))
+        
+        self.VertexCountBefore = len(positions)
+        self.VertexCountAfter  = len(self.Vertices)
+
+        print("Welded %d vertices into %d (%.1f%% less), %d faces dropped" % 
+              (self.VertexCountBefore, self.VertexCountAfter, 
+               100.0 * (1.0 - self.VertexCountAfter / self.VertexCountBefore if self.VertexCountBefore else 0.0), 
+               len(faces) - len(self.Faces)))
+
+    def corner_uvs(self):
+        return self.UV
+
+    def optimize_cache(self, cache_size=VERTEX_CACHE_SIZE):
+        before = acmr(self.Faces, cache_size)
+
+        (face_order, faces, vertex_order) = optimize_vertex_cache(self.Faces, len(self.Vertices), cache_size)
+
+        # UVs stay with their face corners
+        corners = self.UV.reshape(len(self.Faces), 3, *self.UV.shape[1:])[face_order]
+
+        self.Vertices        = self.Vertices[vertex_order]
+        self.Faces           = faces
+        self.UV              = corners.reshape(-1, *self.UV.shape[1:])
+        self.MaterialIndices = self.MaterialIndices[face_order]
+
+        self.ACMR = (before, acmr(faces, cache_size))
+
+# Selection of the batches of a model, applied before any vertex or face
+# of the batch is read. Batches and regions are given by index, materials
+# by name patterns (fnmatch, e.g. "*Shadow*"), criteria left at None accept
+# everything. The predicate is called with (batch index, BAT, REGN, MAT).
+class SubmeshFilter:
+
+    def __init__(self, bats=None, regions=None, materials=None, exclude_materials=None, predicate=None):
+        self.bats              = set(bats) if bats is not None else None
+        self.regions           = set(regions) if regions is not None else None
+        self.materials         = list(materials) if materials is not None else None
+        self.exclude_materials = list(exclude_materials) if exclude_materials is not None else None
+        self.predicate         = predicate
+
+    def accepts(self, index, bat, regn, material):
+        name = material.Name if material is not None else ""
+
+        if self.bats is not None and index not in self.bats:
+            return False
+        if self.regions is not None and bat.REGN_Index not in self.regions:
+            return False
+        if self.materials is not None and not any(fnmatchcase(name, p) for p in self.materials):
+            return False
+        if self.exclude_materials is not None and any(fnmatchcase(name, p) for p in self.exclude_materials):
+            return False
+        if self.predicate is not None and not self.predicate(index, bat, regn, material):
+            return False
+
+        return True
+
+    def spec(self):
+        '''Returns the criteria as JSON, the predicate is not part of it'''
+        return json.dumps({'bats'             : sorted(self.bats) if self.bats is not None else None,
+                           'regions'          : sorted(self.regions) if self.regions is not None else None,
+                           'materials'        : self.materials,
+                           'exclude_materials': self.exclude_materials})
+
+    def from_spec(spec):
+        return SubmeshFilter(**json.loads(spec))
+
+    def parse(bats="", regions="", materials="", exclude_materials=""):
+        '''Creates the filter from comma separated lists, returns None if
+        nothing is filtered. Raises ValueError for indices that are not
+        integers.'''
+        def split(text):
+            items = [item.strip() for item in text.split(",") if item.strip() != ""]
+            return items if items else None
+
+        def indices(text):
+            items = split(text)
+
+            try:
+                return [int(item) for item in items] if items else None
+            except ValueError:
+                raise ValueError("Batch and region indices must be integers: %s" % text)
+
+        if not (split(bats) or split(regions) or split(materials) or split(exclude_materials)):
+            return None
+
+        return SubmeshFilter(indices(bats), indices(regions), split(materials), split(exclude_materials))
+
+# Submeshes of a model decoded region by region while iterating, the file
+# stays open until the last submesh was read
+class SubmeshStream:
+
+    def __init__(self, filepath, filesystem, selection=None, cache_size=0, names=()):
+        # Regions are read one at a time, prefetching all face indices would
+        # keep them in memory until the stream is closed
+        self.file       = M3File(filepath, filesystem, prefetch=SELECTIVE_PREFETCH_TAGS)
+        self.selection  = selection
+        self.cache_size = cache_size
+
+        try:
+            self.model     = M3Header(self.file, MODL23.read_model).m3Model
+            self.sequences = readSequenceRanges(self.file, self.model, names, filepath)
+        except:
+            self.file.close()
+            raise
+
+    def __len__(self):
+        return len(self.model.batches(self.selection))
+
+    def __iter__(self):
+        for submesh in self.model.iter_submeshes(self.file, None, self.selection):
+            if self.cache_size > 0:
+                submesh.optimize_cache(self.cache_size)
 
-class IMPORT_OT_m3(bpy.types.Operator, ImportHelper):
-    '''Import from Blizzard M3 file'''
-    bl_idname = "import_shape.m3"
-    bl_label  = "Import M3"
+            yield submesh
 
-    import_material: BoolProperty(name="Create Material", 
-                                   description="Creates material for the model", 
-                                   default=True)
+    def close(self):
+        self.file.close()
 
-    search_textures: BoolProperty(name="Search Textures", 
-                                  description="Search for textures based on .mpq file structure", 
-                                  default=True)
+def createFileSystem(filepath, search_textures, asset_bundles="", proxy_size=0):
+    filesystem = VirtualFileSystem()
+
+    if proxy_size > 0:
+        filesystem.proxies = TextureProxyCache(proxy_size)
+
+    # Loose files take precedence over the asset bundles. Models inside a
+    # bundle ("Base.zip/Assets/Units/Marine.m3") mount the bundle on open.
+    if os.path.isfile(filepath):
+        index = filepath.rfind('Assets')
+        if search_textures == True and index is not -1:
+            filesystem.mount(filepath[0:index])
+        else:
+            filesystem.mount(os.path.dirname(filepath) or ".")
+
+    for bundle in asset_bundles.split(";"):
+        if bundle.strip() != "":
+            filesystem.mount(bpy.path.abspath(bundle.strip()))
+
+    return filesystem
+
+def readSubmeshes(filepath, filesystem, selection=None):
+    return readModel(filepath, filesystem, selection)[0]
+
+def readModel(filepath, filesystem, selection=None, names=()):
+    '''Returns the submeshes and the time ranges of the named sequences,
+    the file is opened and its model decoded once for both'''
+    file = M3File(filepath, filesystem, prefetch=SELECTIVE_PREFETCH_TAGS if selection is not None else True)
+
+    try:
+        # Reading file header
+        model     = M3Header(file, MODL23.read_model).m3Model
+        submeshes = model.read_submeshes(file, selection)
+        sequences = readSequenceRanges(file, model, names, filepath)
+    finally:
+        file.close()
+
+    return (submeshes, sequences)
+
+def readSequenceRanges(file, model, names, filepath):
+    '''Decodes the animation data of the named sequences from the open file,
+    returns their time range in milliseconds by name. Names not found in
+    the file are left out.'''
+    if not names:
+        return {}
+
+    index   = SequenceIndex(model, file)
+    missing = index.missing(names)
+
+    if missing:
+        print("Unknown sequences in %s: %s" % (filepath, ", ".join(missing)))
+
+    return index.ranges(names)
+
+def prepareProxies(filesystem, materials):
+    '''Generates the missing proxy textures of the materials'''
+    paths = set()
+
+    for material in materials:
+        if material is not None:
+            paths.update(layer.Path for layer in material.Layers.values() if layer.Path)
+
+    for path in sorted(paths):
+        image = filesystem.find(path)
+
+        if image is not None:
+            filesystem.proxies.proxy(image)
+
+def parseFile(filepath, search_textures, asset_bundles="", streaming=False, weld=None, proxy_size=0, selection=None, cache_size=0, sequences=()):
+    '''Reads the submeshes of a file and the time ranges of the named
+    sequences, does not touch Blender data and can run in a worker thread.
+    Returns (file system, submeshes, sequence ranges), the file system
+    stays open for loading the textures. When streaming, the submeshes are
+    decoded one region at a time while they are iterated. weld is None or a tuple
+    (distance, use_normals) merging all submeshes into one WeldedMesh.
+    With a proxy_size, proxy textures are generated here as well. The
+    optional SubmeshFilter selects the batches read. A cache_size above
+    zero reorders faces and vertices for a vertex cache of that size.'''
+    filesystem = createFileSystem(filepath, search_textures, asset_bundles, proxy_size)
+
+    try:
+        if streaming and weld is None:
+            stream = SubmeshStream(filepath, filesystem, selection, cache_size, sequences)
+
+            try:
+                if filesystem.proxies is not None:
+                    prepareProxies(filesystem, [batch[3] for batch in stream.model.batches(selection)])
+            except:
+                stream.close()
+                raise
+
+            return (filesystem, stream, stream.sequences)
+
+        (submeshes, ranges) = readModel(filepath, filesystem, selection, sequences)
+
+        if weld is not None:
+            submeshes = [WeldedMesh(submeshes, *weld)]
+
+        if cache_size > 0:
+            for submesh in submeshes:
+                submesh.optimize_cache(cache_size)
+
+        if filesystem.proxies is not None:
+            prepareProxies(filesystem, [material for submesh in submeshes for material in submesh.Materials])
+
+        return (filesystem, submeshes, ranges)
+    except:
+        filesystem.close()
+        raise
+
+def releaseParsed(filesystem, submeshes):
+    if isinstance(submeshes, SubmeshStream):
+        submeshes.close()
+
+    filesystem.close()
+
+def load(context, filepath, import_material, search_textures, asset_bundles="", streaming=False, weld=None, proxy_size=0, sequences=(), selection=None, cache_size=0):
+    (filesystem, submeshes, ranges) = parseFile(filepath, search_textures, asset_bundles, streaming, weld, proxy_size, selection, cache_size, sequences)
+
+    try:
+        objects = build_submeshes(context, basename(filepath), submeshes, import_material, filesystem, filepath)
+        tagSequences(objects, ranges)
+    finally:
+        releaseParsed(filesystem, submeshes)
+
+    tagOptions(objects, import_material, search_textures, asset_bundles, weld, proxy_size, selection, cache_size)
+
+    return objects
+
+def createMesh(mesh, submesh):
+    # The mesh is filled from the arrays of the submesh with foreach_set,
+    # no Python object is created per vertex or face
+    faces = np.ascontiguousarray(submesh.Faces, np.int32)
+
+    mesh.vertices.add(len(submesh.Vertices))
+    mesh.vertices.foreach_set("co", np.ascontiguousarray(submesh.Vertices, np.float32).ravel())
+
+    mesh.loops.add(faces.size)
+    mesh.loops.foreach_set("vertex_index", faces.ravel())
+
+    mesh.polygons.add(len(faces))
+    mesh.polygons.foreach_set("loop_start", np.arange(0, faces.size, 3, dtype=np.int32))
+    mesh.polygons.foreach_set("loop_total", np.full(len(faces), 3, np.int32))
+    
+    if submesh.MaterialIndices is not None:
+        mesh.polygons.foreach_set("material_index", np.ascontiguousarray(submesh.MaterialIndices, np.int32))
     
-    def execute(self, context):
-        load(context, 
-             self.filepath, 
-             self.import_material,
-             self.search_textures)
+    for l in range(4):
+        mesh.uv_layers.new(name='UV_%d' % l)
 
-        return {'FINISHED'}
+    assignUVs(mesh, submesh)
 
+def assignUVs(mesh, submesh):
+    # UVs are stored per face corner
+    corners = submesh.corner_uvs()
 
-exported_classes = {
-    IMPORT_OT_m3,
-}
+    for l in range(corners.shape[1]):
+        mesh.uv_layers[l].data.foreach_set("uv", np.ascontiguousarray(corners[:, l], np.float32).ravel())
+
+def createSubmeshMaterial(material, filesystem):
+    if bpy.context.scene.render.engine == 'BLENDER_RENDER':
+        return createMaterial(material, filesystem)
+    elif bpy.context.scene.render.engine in ('CYCLES', 'BLENDER_EEVEE', 'BLENDER_EEVEE_NEXT'):
+        return createNodeMaterial(material, filesystem)
+
+    return None
+
+def assignMaterials(mesh, submesh, filesystem):
+    # Slots are kept even without material, so face material indices stay
+    # valid
+    for i, material in enumerate(submesh.Materials):
+        mat = createSubmeshMaterial(material, filesystem)
+
+        if i < len(mesh.materials):
+            mesh.materials[i] = mat
+        else:
+            mesh.materials.append(mat)
+
+    # Slots of materials no longer in the submesh
+    while len(mesh.materials) > len(submesh.Materials):
+        mesh.materials.pop()
+
+def tagObject(ob, filepath, submesh):
+    # Remembers the source of the object for reimport
+    ob["m3_filepath"]      = filepath
+    ob["m3_bat"]           = submesh.Bat
+    ob["m3_region"]        = submesh.Region
+    ob["m3_vertex_hash"]   = submesh.VertexHash
+    ob["m3_topology_hash"] = submesh.TopologyHash
+    ob["m3_material_hash"] = submesh.MaterialHash
+
+    if isinstance(submesh, WeldedMesh):
+        ob["m3_weld_vertices"] = (submesh.VertexCountBefore, submesh.VertexCountAfter)
+
+    if hasattr(submesh, "ACMR"):
+        ob["m3_acmr"] = (submesh.ACMR[0], submesh.ACMR[1], len(submesh.Faces))
+
+def tagOptions(objects, import_material, search_textures, asset_bundles, weld=None, proxy_size=0, selection=None, cache_size=0, import_id=None):
+    # Objects of one import share an id, copies of the same file imported
+    # several times are reimported separately
+    import_id = import_id or uuid.uuid4().hex
+
+    for ob in objects:
+        ob["m3_import_id"]       = import_id
+        ob["m3_import_material"] = import_material
+        ob["m3_search_textures"] = search_textures
+        ob["m3_asset_bundles"]   = asset_bundles
+        ob["m3_proxy_size"]      = proxy_size
+        ob["m3_cache_size"]      = cache_size
+
+        if weld is not None:
+            ob["m3_weld_distance"] = weld[0]
+            ob["m3_weld_normals"]  = weld[1]
+
+        # Reimport reads the same batches, a predicate is not kept
+        if selection is not None:
+            ob["m3_filter"] = selection.spec()
+
+def tagSequences(objects, ranges):
+    '''Records the time ranges in milliseconds of the decoded sequences on
+    the objects'''
+    if not ranges:
+        return
+
+    for ob in objects:
+        ob["m3_sequences"] = ranges
+
+def build_submesh(context, name, submesh, import_material, filesystem, filepath):
+    mesh = bpy.data.meshes.new(name)
+    createMesh(mesh, submesh)
+    
+    mesh.update(True)
+    ob = bpy.data.objects.new(name, mesh)
+    
+    if import_material:
+        assignMaterials(ob.data, submesh, filesystem)
+        
+    #createArmatures(submesh.bones, submesh.iref)
         
+    #for f in ob.data.faces:
+    #    print(f.material_index)
+    #    print(f.index)
+    
+    context.scene.objects.link(ob)
+    tagObject(ob, filepath, submesh)
+
+    return ob
+
+def build_submeshes(context, name, submeshes, import_material, filesystem, filepath):
+    return [build_submesh(context, name, submesh, import_material, filesystem, filepath) 
+            for submesh in submeshes]
+
+def importedObjects(filepath=None):
+    '''Returns the objects created from the given .m3 file, or from any
+    file if no path is given'''
+    return [ob for ob in bpy.data.objects 
+            if "m3_filepath" in ob and (filepath is None or ob["m3_filepath"] == filepath)]
+
+def reimport(context, filepath):
+    '''Updates the objects created from filepath in place. Only regions
+    whose content hash changed are rewritten. Every import of the file is
+    updated with its own options. Returns the number of updated,
+    unchanged, added and removed objects.'''
+    imports = {}
+
+    for ob in importedObjects(filepath):
+        imports.setdefault(ob.get("m3_import_id"), []).append(ob)
+
+    counts = (0, 0, 0, 0)
+
+    for (import_id, objects) in imports.items():
+        counts = tuple(a + b for a, b in zip(counts, reimportObjects(context, filepath, objects, import_id)))
+
+    return counts
+
+def reimportObjects(context, filepath, imported, import_id):
+    # Objects by batch, objects imported before import ids were stored may
+    # hold several copies of a batch
+    objects = {}
+
+    for ob in imported:
+        objects.setdefault(ob["m3_bat"], []).append(ob)
+
+    first           = imported[0]
+    import_material = first.get("m3_import_material", True)
+    search_textures = first.get("m3_search_textures", True)
+    asset_bundles   = first.get("m3_asset_bundles", "")
+    proxy_size      = first.get("m3_proxy_size", 0)
+    cache_size      = first.get("m3_cache_size", 0)
+    filesystem      = createFileSystem(filepath, search_textures, asset_bundles, proxy_size)
+    weld            = None
+    selection       = None
+
+    if "m3_filter" in first:
+        selection = SubmeshFilter.from_spec(first["m3_filter"])
+
+    if "m3_weld_distance" in first:
+        weld = (first["m3_weld_distance"], bool(first["m3_weld_normals"]))
+
+    updated   = 0
+    unchanged = 0
+    added     = []
+
+    try:
+        submeshes = readSubmeshes(filepath, filesystem, selection)
+
+        if weld is not None:
+            submeshes = [WeldedMesh(submeshes, *weld)]
+
+        if cache_size > 0:
+            for submesh in submeshes:
+                submesh.optimize_cache(cache_size)
+
+        for submesh in submeshes:
+            copies = objects.pop(submesh.Bat, None)
+
+            if copies is None:
+                added.append(submesh)
+                continue
+
+            for ob in copies:
+                mesh = ob.data
+                
+                vertices_changed = ob["m3_vertex_hash"]   != submesh.VertexHash
+                topology_changed = ob["m3_topology_hash"] != submesh.TopologyHash
+                material_changed = ob["m3_material_hash"] != submesh.MaterialHash
+
+                if not (vertices_changed or topology_changed or material_changed):
+                    unchanged += 1
+                    continue
+
+                if topology_changed or len(mesh.vertices) != len(submesh.Vertices):
+                    mesh.clear_geometry()
+                    createMesh(mesh, submesh)
+                elif vertices_changed:
+                    # Same topology, positions and UVs are rewritten in place
+                    mesh.vertices.foreach_set("co", np.ascontiguousarray(submesh.Vertices, np.float32).ravel())
+                    assignUVs(mesh, submesh)
+
+                mesh.update(True)
+
+                if material_changed and import_material:
+                    assignMaterials(mesh, submesh, filesystem)
+
+                tagObject(ob, filepath, submesh)
+                updated += 1
+
+        objects_added = build_submeshes(context, basename(filepath), added, import_material, filesystem, filepath)
+    finally:
+        filesystem.close()
+
+    tagOptions(objects_added, import_material, search_textures, asset_bundles, weld, proxy_size, selection, cache_size, import_id)
+
+    # Batches which no longer exist in the file
+    removed = [ob for copies in objects.values() for ob in copies]
+
+    for ob in removed:
+        bpy.data.objects.remove(ob)
+
+    return (updated, unchanged, len(objects_added), len(removed))
+
+# Source files watched for changes, path -> (modification time, size)
+watched_files = {}
+watch_interval = 1.0
+
+def watchTimer():
+    '''Timer reimporting changed .m3 files, the file has to be unchanged
+    for one interval before it is read, so files still being written by
+    an external tool are not picked up'''
+    if not watched_files:
+        return None
+
+    for filepath in {ob["m3_filepath"] for ob in importedObjects()}:
+        try:
+            stat  = os.stat(filepath)
+        except OSError:
+            continue
+
+        state = (stat.st_mtime, stat.st_size)
+        known = watched_files.get(filepath)
+
+        if known is None:
+            watched_files[filepath] = (state, state)
+            continue
+
+        (imported, seen) = known
+
+        if state != imported and state == seen:
+            try:
+                print("Reimporting %s: %d updated, %d unchanged, %d added, %d removed" % 
+                      ((filepath,) + reimport(bpy.context, filepath)))
+            except Exception as err:
+                print("Cannot reimport: %s (%s)" % (filepath, str(err)))
+                continue
+
+            watched_files[filepath] = (state, state)
+        else:
+            watched_files[filepath] = (imported, state)
+
+    return watch_interval
+
+# Seconds of each timer event spent building meshes during a modal import
+IMPORT_TIME_SLICE = 0.05
+
+def closeParsed(future):
+    if not future.cancelled() and future.exception() is None:
+        (filesystem, submeshes, ranges) = future.result()
+        releaseParsed(filesystem, submeshes)
+
+# Operators are only available when running inside Blender
+if bpy is not None:
+
+    class IMPORT_OT_m3(bpy.types.Operator, ImportHelper):
+        '''Import from Blizzard M3 file'''
+        bl_idname = "import_shape.m3"
+        bl_label  = "Import M3"
+
+        files: CollectionProperty(type=bpy.types.OperatorFileListElement,
+                                  options={'HIDDEN', 'SKIP_SAVE'})
+
+        directory: StringProperty(subtype='DIR_PATH',
+                                  options={'HIDDEN', 'SKIP_SAVE'})
+
+        import_material: BoolProperty(name="Create Material", 
+                                       description="Creates material for the model", 
+                                       default=True)
+
+        search_textures: BoolProperty(name="Search Textures", 
+                                      description="Search for textures based on .mpq file structure", 
+                                      default=True)
+
+        asset_bundles: StringProperty(name="Asset Bundles",
+                                      description="Semicolon separated list of .zip/.tar bundles searched for models and textures",
+                                      default="")
+
+        streaming: BoolProperty(name="Stream Regions",
+                                description="Decode the vertices region by region, memory scales with the largest region instead of the whole model",
+                                default=False)
+
+        weld_vertices: BoolProperty(name="Weld Vertices",
+                                    description="Merge all regions into one mesh and weld the vertices duplicated along region seams",
+                                    default=False)
+
+        weld_distance: FloatProperty(name="Weld Distance",
+                                     description="Vertices closer than this distance are merged",
+                                     default=0.0001, min=0.0, precision=5)
+
+        weld_normals: BoolProperty(name="Weld Matching Normals Only",
+                                   description="Only merge vertices with the same normal, hard edges are kept",
+                                   default=False)
+
+        proxy_textures: BoolProperty(name="Proxy Textures",
+                                     description="Use cached low resolution copies of the textures in the viewport, final renders use the full resolution",
+                                     default=False)
+
+        proxy_size: IntProperty(name="Proxy Size",
+                                description="Largest side of the proxy textures in pixels",
+                                default=256, min=16, max=4096)
+
+        sequences: StringProperty(name="Sequences",
+                                  description="Comma separated names of the animation sequences to decode, e.g. Stand,Walk. Other sequences are skipped",
+                                  default="")
+
+        filter_batches: StringProperty(name="Batches",
+                                       description="Comma separated batch indices to import, all when empty",
+                                       default="")
+
+        filter_regions: StringProperty(name="Regions",
+                                       description="Comma separated region indices to import, all when empty",
+                                       default="")
+
+        filter_materials: StringProperty(name="Materials",
+                                         description="Comma separated material name patterns to import, e.g. Weapon*, all when empty",
+                                         default="")
+
+        exclude_materials: StringProperty(name="Exclude Materials",
+                                          description="Comma separated material name patterns skipped, e.g. *Shadow*,*FX*",
+                                          default="")
+
+        optimize_cache: BoolProperty(name="Optimize Vertex Cache",
+                                     description="Reorder faces and vertices for the GPU vertex cache, the cache miss ratio before and after is reported",
+                                     default=False)
+
+        def filepaths(self):
+            if self.directory and len(self.files) > 0:
+                return [os.path.join(self.directory, f.name) for f in self.files if f.name != ""]
+
+            return [self.filepath] if self.filepath else []
+
+        def execute(self, context):
+            filepaths     = self.filepaths()
+            asset_bundles = ";".join(bpy.path.abspath(b.strip()) for b in self.asset_bundles.split(";") if b.strip() != "")
+            weld          = (self.weld_distance, self.weld_normals) if self.weld_vertices else None
+            proxy_size    = self.proxy_size if self.proxy_textures else 0
+            cache_size    = VERTEX_CACHE_SIZE if self.optimize_cache else 0
+            sequences     = [name.strip() for name in self.sequences.split(",") if name.strip() != ""]
+
+            try:
+                selection = SubmeshFilter.parse(self.filter_batches, self.filter_regions, 
+                                                self.filter_materials, self.exclude_materials)
+            except ValueError as err:
+                self.report({'ERROR'}, "Invalid filter (%s)" % str(err))
+                return {'CANCELLED'}
+
+            # A directory confirmed without picking a file
+            if len(filepaths) == 0:
+                self.report({'ERROR'}, "No .m3 file selected")
+                return {'CANCELLED'}
+
+            # Without a window (scripts, background mode) the import is synchronous
+            if bpy.app.background or context.window is None:
+                objects = []
+
+                for filepath in filepaths:
+                    imported = load(context, 
+                                    filepath, 
+                                    self.import_material,
+                                    self.search_textures,
+                                    asset_bundles,
+                                    self.streaming,
+                                    weld,
+                                    proxy_size,
+                                    sequences,
+                                    selection,
+                                    cache_size)
+
+                    if len(imported) > 0:
+                        self.report_sequences(filepath, sequences, imported[0].get("m3_sequences", {}))
+
+                    objects += imported
+
+                self.report_weld(objects)
+
+                return {'FINISHED'}
+
+            # Files are parsed by worker threads, meshes are built in the modal
+            # handler in time slices to keep the interface responsive
+            self.executor = ThreadPoolExecutor(max_workers=min(len(filepaths), os.cpu_count() or 1))
+            self.pending  = [(filepath, self.executor.submit(parseFile, filepath, self.search_textures, asset_bundles, self.streaming, weld, proxy_size, selection, cache_size, sequences))
+                             for filepath in filepaths]
+            self.current  = None
+            self.total    = len(filepaths)
+            self.done     = 0
+            self.imported = 0
+            self.objects  = []
+
+            self.options   = (self.import_material, self.search_textures, asset_bundles, weld, proxy_size, selection, cache_size)
+            self.requested = sequences
+
+            wm = context.window_manager
+            self.timer = wm.event_timer_add(0.01, window=context.window)
+            wm.modal_handler_add(self)
+            wm.progress_begin(0, self.total)
+
+            return {'RUNNING_MODAL'}
+
+        def modal(self, context, event):
+            if event.type == 'ESC':
+                self.cancel(context)
+                self.report({'WARNING'}, "Import cancelled, %d of %d files imported" % (self.imported, self.total))
+                return {'CANCELLED'}
+
+            if event.type != 'TIMER':
+                return {'PASS_THROUGH'}
+
+            deadline = time.perf_counter() + IMPORT_TIME_SLICE
+
+            while time.perf_counter() < deadline:
+                if self.current is None:
+                    if len(self.pending) == 0:
+                        self.finish(context)
+                        self.report({'INFO'}, "Imported %d of %d files" % (self.imported, self.total))
+                        self.report_weld(self.objects)
+                        return {'FINISHED'}
+
+                    (filepath, future) = self.pending[0]
+
+                    if not future.done():
+                        break
+
+                    self.pending.pop(0)
+
+                    try:
+                        (filesystem, submeshes, ranges) = future.result()
+                    except Exception as err:
+                        self.report({'WARNING'}, "Cannot import %s (%s)" % (filepath, str(err)))
+                        self.done += 1
+                        continue
+
+                    self.current = (filepath, filesystem, submeshes, iter(submeshes), [], ranges)
+                    self.report_sequences(filepath, self.requested, ranges)
+
+                (filepath, filesystem, submeshes, remaining, objects, ranges) = self.current
+
+                if len(objects) < len(submeshes):
+                    try:
+                        objects.append(build_submesh(context, basename(filepath), next(remaining), 
+                                                     self.options[0], filesystem, filepath))
+                    except Exception as err:
+                        # Streamed regions are read here, a broken file must
+                        # not stop the remaining imports
+                        self.report({'WARNING'}, "Cannot import %s (%s)" % (filepath, str(err)))
+                        releaseParsed(filesystem, submeshes)
+                        tagOptions(objects, *self.options)
+
+                        self.current  = None
+                        self.done    += 1
+                        continue
+
+                if len(objects) == len(submeshes):
+                    tagSequences(objects, ranges)
+                    releaseParsed(filesystem, submeshes)
+                    tagOptions(objects, *self.options)
+
+                    self.objects  += objects
+                    self.current   = None
+                    self.done     += 1
+                    self.imported += 1
+
+            progress = self.done
+
+            if self.current is not None and len(self.current[2]) > 0:
+                progress += len(self.current[4]) / len(self.current[2])
+
+            context.window_manager.progress_update(progress)
+
+            return {'RUNNING_MODAL'}
+
+        def report_sequences(self, filepath, names, ranges):
+            missing = [name for name in names if name not in ranges]
+
+            if len(missing) > 0:
+                self.report({'WARNING'}, "Sequences not found in %s: %s" % (basename(filepath), ", ".join(missing)))
+
+        def report_weld(self, objects):
+            welded = [ob["m3_weld_vertices"] for ob in objects if "m3_weld_vertices" in ob]
+
+            if len(welded) > 0:
+                before = sum(w[0] for w in welded)
+                after  = sum(w[1] for w in welded)
+                self.report({'INFO'}, "Welded %d vertices into %d (%.1f%% less)" % 
+                            (before, after, 100.0 * (1.0 - after / before if before else 0.0)))
+
+            # Cache miss ratios weighted by the face count of each mesh
+            optimized = [ob["m3_acmr"] for ob in objects if "m3_acmr" in ob]
+            faces     = sum(a[2] for a in optimized)
+
+            if faces > 0:
+                before = sum(a[0] * a[2] for a in optimized) / faces
+                after  = sum(a[1] * a[2] for a in optimized) / faces
+                self.report({'INFO'}, "Vertex cache miss ratio %.3f before, %.3f after reordering" % (before, after))
+
+        def finish(self, context):
+            wm = context.window_manager
+            wm.event_timer_remove(self.timer)
+            wm.progress_end()
+            self.executor.shutdown(wait=False)
+
+        def cancel(self, context):
+            for (filepath, future) in self.pending:
+                if not future.cancel():
+                    # Parsing already started, the file system is closed once
+                    # the worker is done
+                    future.add_done_callback(closeParsed)
+
+            if self.current is not None:
+                releaseParsed(self.current[1], self.current[2])
+                tagOptions(self.current[4], *self.options)
+
+            self.pending = []
+            self.current = None
+            self.finish(context)
+
+    class IMPORT_OT_m3_reimport(bpy.types.Operator):
+        '''Update objects imported from Blizzard M3 files, only changed regions are rewritten'''
+        bl_idname = "import_shape.m3_reimport"
+        bl_label  = "Reimport M3"
+
+        def execute(self, context):
+            objects = [ob for ob in context.selected_objects if "m3_filepath" in ob] or importedObjects()
+
+            for filepath in {ob["m3_filepath"] for ob in objects}:
+                (updated, unchanged, added, removed) = reimport(context, filepath)
+                self.report({'INFO'}, "%s: %d updated, %d unchanged, %d added, %d removed" % 
+                            (basename(filepath), updated, unchanged, added, removed))
+
+            return {'FINISHED'}
+
+    class IMPORT_OT_m3_watch(bpy.types.Operator):
+        '''Toggle automatic reimport of changed Blizzard M3 files'''
+        bl_idname = "import_shape.m3_watch"
+        bl_label  = "Watch M3 Files"
+
+        interval: FloatProperty(name="Interval",
+                                description="Seconds between checks for changed files",
+                                default=1.0,
+                                min=0.1)
+
+        def execute(self, context):
+            global watch_interval
+
+            if bpy.app.timers.is_registered(watchTimer):
+                bpy.app.timers.unregister(watchTimer)
+                watched_files.clear()
+                self.report({'INFO'}, "Stopped watching M3 files")
+            else:
+                watch_interval = self.interval
+
+                for ob in importedObjects():
+                    stat  = os.stat(ob["m3_filepath"]) if os.path.isfile(ob["m3_filepath"]) else None
+                    state = (stat.st_mtime, stat.st_size) if stat else None
+                    watched_files[ob["m3_filepath"]] = (state, state)
+
+                bpy.app.timers.register(watchTimer, first_interval=watch_interval, persistent=True)
+                self.report({'INFO'}, "Watching %d M3 files" % len(watched_files))
+
+            return {'FINISHED'}
+
+
+    @persistent
+    def useFullResolutionTextures(scene, *args):
+        for image in bpy.data.images:
+            if "m3_full_resolution" in image and image.filepath != image["m3_full_resolution"]:
+                image.filepath = image["m3_full_resolution"]
+                image.reload()
+
+    @persistent
+    def useProxyTextures(scene, *args):
+        for image in bpy.data.images:
+            if "m3_proxy" in image and image.filepath != image["m3_proxy"]:
+                image.filepath = image["m3_proxy"]
+                image.reload()
+
+    render_handlers = (
+        # Once per render job, not per frame of an animation
+        (bpy.app.handlers.render_init,     useFullResolutionTextures),
+        (bpy.app.handlers.render_complete, useProxyTextures),
+        (bpy.app.handlers.render_cancel,   useProxyTextures),
+    )
+
+    exported_classes = {
+        IMPORT_OT_m3,
+        IMPORT_OT_m3_reimport,
+        IMPORT_OT_m3_watch,
+    }
+
+
 def menu_func(self, context):
     self.layout.operator(IMPORT_OT_m3.bl_idname, text="Blizzard M3 (.m3)")
+    self.layout.operator(IMPORT_OT_m3_reimport.bl_idname, text="Reimport Blizzard M3")
 
 def register():
     for c in exported_classes:
         bpy.utils.register_class(c)
     bpy.types.TOPBAR_MT_file_import.append(menu_func)
+    for (handlers, handler) in render_handlers:
+        handlers.append(handler)
 def unregister():
     for c in reversed(exported_classes):
         bpy.utils.unregister_class(c)
     bpy.types.TOPBAR_MT_file_import.remove(menu_func)
+    for (handlers, handler) in render_handlers:
+        if handler in handlers:
+            handlers.remove(handler)
+
+
+def main(argv):
+    '''Command line converter to glTF, used when the script runs outside of
+    Blender'''
+    parser = argparse.ArgumentParser(description="Convert Blizzard M3 models (.m3) into glTF 2.0 binaries (.glb)")
+    parser.add_argument("files", nargs="+",
+                        help="models to convert, paths into bundles like Base.zip/Assets/Units/Marine.m3 are supported")
+    parser.add_argument("-o", "--output",
+                        help="output directory, by default the .glb is written next to the model")
+    parser.add_argument("--texture-ext",
+                        help="replaces the extension of the texture URIs, e.g. .png for converted textures")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes")
+    parser.add_argument("--trace", metavar="DIR",
+                        help="writes a log of the file accesses of every model into DIR and prints their statistics")
+    parser.add_argument("--optimize", action="store_true",
+                        help="reorders faces and vertices for the GPU vertex cache and prints the cache miss ratio")
+    args = parser.parse_args(argv)
+
+    if args.trace is not None:
+        # Worker processes read the directory from the environment
+        global TRACE_DIRECTORY
+        TRACE_DIRECTORY = os.environ["BLENDM3_TRACE"] = args.trace
+
+    jobs = []
+
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+
+    for filepath in args.files:
+        directory = args.output
+
+        if directory is None:
+            split     = split_archive_path(filepath) if not os.path.isfile(filepath) else None
+            directory = os.path.dirname(split[0] if split else filepath)
+
+        output = os.path.join(directory, os.path.splitext(basename(filepath))[0] + ".glb")
+        jobs.append((filepath, output))
+
+    failures = 0
+
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        futures = [(filepath, executor.submit(convert_to_gltf, filepath, output, args.texture_ext,
+                                                         VERTEX_CACHE_SIZE if args.optimize else 0)) 
+                   for (filepath, output) in jobs]
+
+        for (filepath, future) in futures:
+            try:
+                print("Converted %s to %s" % (filepath, future.result()))
+            except Exception as err:
+                print("Cannot convert %s (%s)" % (filepath, str(err)))
+                failures += 1
+
+    return 1 if failures else 0
 
 
 if __name__ == "__main__":
-    register()
+    if bpy is not None:
+        register()
+    else:
+        sys.exit(main(sys.argv[1:]))